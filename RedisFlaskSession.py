@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+from collections import MutableMapping
+from uuid import uuid4
+from flask.sessions import SessionInterface, SessionMixin
+from RedisObjects import RedisDict
+import re
+
+SESSION_ID = re.compile(r'^[0-9a-f]{32}$')
+
+# SessionMixin is a MutableMapping itself from Flask 1.0 on; listing both
+# there would leave no consistent method resolution order.
+if issubclass(SessionMixin, MutableMapping):
+    SessionBase = SessionMixin
+else:
+    class SessionBase(MutableMapping, SessionMixin):
+        pass
+
+class RedisSession(SessionBase):
+    """Flask session kept in one RedisDict. The hash is read with a single
+    HGETALL the first time the request touches the session; after that
+    reads and writes stay in memory. flush sends only the fields whose
+    encoded value changed, the removed fields and the sliding expiry in one
+    pipeline, so in-place changes to mutable values are saved too. An id
+    with no hash behind it is replaced by a fresh one, so a client cannot
+    choose the id of the session it will get.
+
+    commands and round_trips count what the session cost this request.
+    """
+    def __init__(self, redis_dict, sid, new=False):
+        self.redis_dict = redis_dict
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.accessed = False
+        self.regenerated = False
+        self.commands = 0
+        self.round_trips = 0
+        self._data = None
+        self._loaded = {}
+
+    @property
+    def data(self):
+        if self._data is None:
+            self.accessed = True
+            if not self.new:
+                self._loaded = self.redis_dict.r.hgetall(self.redis_dict.name)
+                self.commands += 1
+                self.round_trips += 1
+                if not self._loaded:
+                    self.regenerate()
+            self._data = dict((self.redis_dict.unpickle_key(field), self.redis_dict.unpickle(value)) for field, value in self._loaded.iteritems())
+        return self._data
+
+    def regenerate(self):
+        """Moves the session to a new random id, sent in the next cookie.
+        Its data is written in full under the new id at the end of the
+        request; the old hash is left to expire.
+        """
+        redis_dict = self.redis_dict
+        prefix = redis_dict.name[:len(redis_dict.name) - len(self.sid)]
+        self.sid = uuid4().hex
+        self.new = True
+        self.regenerated = True
+        self._loaded = {}
+        self.redis_dict = RedisDict(prefix + self.sid, redis_dict.host, redis_dict.port, redis_dict.db, key_codec=redis_dict.key_codec, value_codec=redis_dict.value_codec, ttl=redis_dict.expiry, **redis_dict.connection_kwargs)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.modified = True
+
+    def __delitem__(self, key):
+        del(self.data[key])
+        self.modified = True
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return '<{} {} {!r}>'.format(type(self).__name__, self.sid, self.data)
+
+    def flush(self):
+        """Writes back what changed since the session was read and restarts
+        its expiry; does nothing if the request never used the session.
+        """
+        if self._data is None or (self.new and not self._data):
+            return
+        redis_dict = self.redis_dict
+        current = dict((redis_dict.pickle_key(key), redis_dict.pickle(value)) for key, value in self._data.iteritems())
+        changed = dict((field, value) for field, value in current.iteritems() if self._loaded.get(field) != value)
+        deleted = [field for field in self._loaded if field not in current]
+        def write(pipe):
+            if changed:
+                pipe.hset(redis_dict.name, mapping=changed)
+            if deleted:
+                pipe.hdel(redis_dict.name, *deleted)
+        if changed or deleted:
+            # The RedisDict adds the expiry to the same pipeline.
+            redis_dict._write(write, changed.keys() + deleted, transaction=False)
+            self.commands += bool(changed) + bool(deleted) + 1
+        else:
+            redis_dict.expire(redis_dict.expiry)
+            self.commands += 1
+        self.round_trips += 1
+        self._loaded = current
+
+class RedisSessionInterface(SessionInterface):
+    """Stores each session in a RedisDict named prefix + session id, expiring
+    ttl seconds (default: the app's permanent_session_lifetime) after the
+    last request that used it. The cookie only carries the random id.
+    Totals of the commands and round trips spent are kept in stats, and
+    with app.debug each response reports its own in an X-Session-Commands
+    header.
+    """
+    session_class = RedisSession
+
+    def __init__(self, prefix='session:', ttl=None, host='localhost', port=6379, db=0, **redis_kwargs):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.host = host
+        self.port = port
+        self.db = db
+        self.redis_kwargs = redis_kwargs
+        self.stats = {'requests': 0, 'commands': 0, 'round_trips': 0}
+
+    def session_ttl(self, app):
+        if self.ttl is not None:
+            return self.ttl
+        return app.permanent_session_lifetime.total_seconds()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        new = sid is None or not SESSION_ID.match(sid)
+        if new:
+            sid = uuid4().hex
+        redis_dict = RedisDict(self.prefix + sid, self.host, self.port, self.db, ttl=self.session_ttl(app), **self.redis_kwargs)
+        return self.session_class(redis_dict, sid, new)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        session.flush()
+        self.stats['requests'] += 1
+        self.stats['commands'] += session.commands
+        self.stats['round_trips'] += session.round_trips
+        if app.debug:
+            response.headers['X-Session-Commands'] = str(session.commands)
+        if not session.accessed:
+            return
+        response.vary.add('Cookie')
+        if not session:
+            if not session.new or session.regenerated:
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        if session.new or self.should_set_cookie(app, session):
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain,
+                                path=path,
+                                secure=self.get_cookie_secure(app))
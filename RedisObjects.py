@@ -1,90 +1,1728 @@
 #!/usr/bin/env python
 
-from itertools import izip
+from itertools import izip, islice, chain, count
+from collections import OrderedDict, defaultdict
 from contextlib import contextmanager
+from functools import wraps, partial
+from types import GeneratorType
+from uuid import uuid4
+from bisect import bisect_left
+import threading
+import weakref
+import os
+import socket
+import inspect
 import redis
 import pickle
+import json
+import zlib
+import struct
 import atexit
+import time
+
+try:
+    import cPickle
+except ImportError:
+    cPickle = pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Returns every ARGV[3]th value of LRANGE KEYS[1] ARGV[1] ARGV[2], walking
+# backwards from the end of the range for a negative step.
+LRANGE_STEP_SCRIPT = """
+local values = redis.call('LRANGE', KEYS[1], ARGV[1], ARGV[2])
+local step = tonumber(ARGV[3])
+local first, last = 1, #values
+if step < 0 then
+    first, last = #values, 1
+end
+local result = {}
+for i = first, last, step do
+    result[#result + 1] = values[i]
+end
+return result
+"""
+
+# Removes and returns the value at index ARGV[1] by overwriting it with the
+# unique tombstone ARGV[2] and removing that, or returns nil when out of range.
+LPOP_INDEX_SCRIPT = """
+local value = redis.call('LINDEX', KEYS[1], ARGV[1])
+if not value then
+    return false
+end
+redis.call('LSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('LREM', KEYS[1], 1, ARGV[2])
+return value
+"""
+
+# Inserts ARGV[2] before index ARGV[1], clamped like list.insert, by marking
+# the value there with the unique tombstone ARGV[3] as LINSERT's pivot and
+# restoring it afterwards; returns the new length.
+LINSERT_INDEX_SCRIPT = """
+local length = redis.call('LLEN', KEYS[1])
+local index = tonumber(ARGV[1])
+if index < 0 then
+    index = index + length
+end
+if index <= 0 then
+    return redis.call('LPUSH', KEYS[1], ARGV[2])
+end
+if index >= length then
+    return redis.call('RPUSH', KEYS[1], ARGV[2])
+end
+local value = redis.call('LINDEX', KEYS[1], index)
+redis.call('LSET', KEYS[1], index, ARGV[3])
+redis.call('LINSERT', KEYS[1], 'BEFORE', ARGV[3], ARGV[2])
+redis.call('LSET', KEYS[1], index + 1, value)
+return length + 1
+"""
+
+# Deletes the Python slice ARGV[1]:ARGV[2]:ARGV[3] (empty strings for None)
+# using the unique tombstone ARGV[4]; returns the number of values removed.
+LDEL_SLICE_SCRIPT = """
+local length = redis.call('LLEN', KEYS[1])
+local step = tonumber(ARGV[3])
+local lower, upper = 0, length
+if step < 0 then
+    lower, upper = -1, length - 1
+end
+local function bound(value, default)
+    if value == '' then
+        return default
+    end
+    value = tonumber(value)
+    if value < 0 then
+        value = value + length
+        if value < lower then
+            value = lower
+        end
+    elseif value > upper then
+        value = upper
+    end
+    return value
+end
+local start = bound(ARGV[1], step < 0 and upper or lower)
+local stop = bound(ARGV[2], step < 0 and lower or upper)
+if step == 1 and start < stop and (start == 0 or stop == length) then
+    if start == 0 then
+        redis.call('LTRIM', KEYS[1], stop, -1)
+    else
+        redis.call('LTRIM', KEYS[1], 0, start - 1)
+    end
+    return stop - start
+end
+local last = stop - 1
+if step < 0 then
+    last = stop + 1
+end
+local removed = 0
+for i = start, last, step do
+    redis.call('LSET', KEYS[1], i, ARGV[4])
+    removed = removed + 1
+end
+if removed > 0 then
+    redis.call('LREM', KEYS[1], 0, ARGV[4])
+end
+return removed
+"""
+
+# Reverses the list in place; LPUSH of values in order leaves them reversed.
+LREVERSE_SCRIPT = """
+local values = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+for i = 1, #values, 1000 do
+    redis.call('LPUSH', KEYS[1], unpack(values, i, math.min(i + 999, #values)))
+end
+return #values
+"""
+
+# Deletes the lock KEYS[1] only while it still holds the holder's token ARGV[1].
+LOCK_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Resets the expiry of the lock KEYS[1] to ARGV[2] milliseconds while it still
+# holds the holder's token ARGV[1].
+LOCK_EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Deletes the child objects that fields ARGV[3..] of hash KEYS[1] (all of its
+# fields when none are given) reference with the prefix ARGV[1], recursing
+# into child hashes. Only children named under their parent (parent:...) are
+# followed, so a value that merely looks like a reference deletes nothing
+# else. When ARGV[2] is 1 the fields, or the whole hash, are deleted as well
+# and the number of them removed is returned.
+NESTED_DROP_SCRIPT = """
+local prefix = ARGV[1]
+local function drop(parent, values)
+    local namespace = parent .. ':'
+    for _, value in ipairs(values) do
+        if value and string.sub(value, 1, #prefix) == prefix then
+            local name = string.sub(value, #prefix + 1)
+            if string.sub(name, 1, #namespace) == namespace then
+                if redis.call('TYPE', name)['ok'] == 'hash' then
+                    drop(name, redis.call('HVALS', name))
+                end
+                redis.call('DEL', name)
+            end
+        end
+    end
+end
+if #ARGV > 2 then
+    drop(KEYS[1], redis.call('HMGET', KEYS[1], unpack(ARGV, 3)))
+    if ARGV[2] == '1' then
+        return redis.call('HDEL', KEYS[1], unpack(ARGV, 3))
+    end
+else
+    drop(KEYS[1], redis.call('HVALS', KEYS[1]))
+    if ARGV[2] == '1' then
+        return redis.call('DEL', KEYS[1])
+    end
+end
+return 0
+"""
+
+# Moves one ARGV[1] from processing list KEYS[2] back to end ARGV[2] (LEFT or
+# RIGHT) of queue KEYS[1]; returns 1, or 0 when it was not there.
+REQUEUE_SCRIPT = """
+if redis.call('LREM', KEYS[2], 1, ARGV[1]) == 0 then
+    return 0
+end
+if ARGV[2] == 'LEFT' then
+    redis.call('LPUSH', KEYS[1], ARGV[1])
+else
+    redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+# Moves all values in the processing lists (named ARGV[2] .. consumer) of the
+# consumers whose lease in sorted set KEYS[2] ended by ARGV[1] back to end
+# ARGV[3] of queue KEYS[1], so they are taken again in their original order.
+# Returns the number of values moved.
+REQUEUE_EXPIRED_SCRIPT = """
+local moved = 0
+local from = ARGV[3] == 'LEFT' and 'RIGHT' or 'LEFT'
+for _, consumer in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])) do
+    while redis.call('LMOVE', ARGV[2] .. consumer, KEYS[1], from, ARGV[3]) do
+        moved = moved + 1
+    end
+    redis.call('ZREM', KEYS[2], consumer)
+end
+return moved
+"""
+
+# Sets ARGV[2] field/value pairs, given in ARGV[3..], of record KEYS[1] with id
+# ARGV[1], adds the id to set KEYS[2] and points unique index hashes KEYS[3..]
+# (one per indexed field, named in the ARGV after the pairs, followed by a
+# '1' for each field whose new value is blank) from the new values to the id,
+# dropping the entries of the values replaced. Blank values are not indexed.
+# Returns 1, or the first indexed field whose new value belongs to another
+# id, in which case nothing is written.
+COLLECTION_SAVE_SCRIPT = """
+local id = ARGV[1]
+local pairs = tonumber(ARGV[2])
+local indexes = #KEYS - 2
+local values = {}
+for i = 3, 2 + 2 * pairs, 2 do
+    values[ARGV[i]] = ARGV[i + 1]
+end
+for k = 3, #KEYS do
+    local field = ARGV[2 * pairs + k]
+    local blank = ARGV[2 * pairs + indexes + k] == '1'
+    local owner = values[field] and not blank and redis.call('HGET', KEYS[k], values[field])
+    if owner and owner ~= id then
+        return field
+    end
+end
+for k = 3, #KEYS do
+    local field = ARGV[2 * pairs + k]
+    if values[field] then
+        local old = redis.call('HGET', KEYS[1], field)
+        if old and old ~= values[field] and redis.call('HGET', KEYS[k], old) == id then
+            redis.call('HDEL', KEYS[k], old)
+        end
+        if ARGV[2 * pairs + indexes + k] ~= '1' then
+            redis.call('HSET', KEYS[k], values[field], id)
+        end
+    end
+end
+if pairs > 0 then
+    redis.call('HSET', KEYS[1], unpack(ARGV, 3, 2 + 2 * pairs))
+end
+redis.call('SADD', KEYS[2], id)
+return 1
+"""
+
+# Deletes record KEYS[1] with id ARGV[1], removes the id from set KEYS[2] and
+# the entries of its values of fields ARGV[2..] from index hashes KEYS[3..].
+# Returns 1 if the record existed.
+COLLECTION_DELETE_SCRIPT = """
+for k = 3, #KEYS do
+    local value = redis.call('HGET', KEYS[1], ARGV[k - 1])
+    if value and redis.call('HGET', KEYS[k], value) == ARGV[1] then
+        redis.call('HDEL', KEYS[k], value)
+    end
+end
+redis.call('SREM', KEYS[2], ARGV[1])
+return redis.call('DEL', KEYS[1])
+"""
+
+# Returns 1 or 0 for each field in ARGV, whether hash KEYS[1] has it.
+HEXISTS_MANY_SCRIPT = """
+local exists = {}
+for i, field in ipairs(ARGV) do
+    exists[i] = redis.call('HEXISTS', KEYS[1], field)
+end
+return exists
+"""
+
+# Deletes the fields of hash KEYS[1] named by the ARGV pairs (field, value)
+# that still hold value. Returns the fields that another client changed
+# meanwhile and the fields it deleted, as two lists.
+HDEL_IF_EQUAL_SCRIPT = """
+local changed, removed = {}, {}
+for i = 1, #ARGV, 2 do
+    local current = redis.call('HGET', KEYS[1], ARGV[i])
+    if current == ARGV[i + 1] then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    elseif current then
+        changed[#changed + 1] = ARGV[i]
+    else
+        removed[#removed + 1] = ARGV[i]
+    end
+end
+return {changed, removed}
+"""
+
+# Sets the fields of hash KEYS[1] named by the ARGV triples (field, expected,
+# value) that are missing or still hold expected.
+HSET_IF_EQUAL_SCRIPT = """
+for i = 1, #ARGV, 3 do
+    local current = redis.call('HGET', KEYS[1], ARGV[i])
+    if not current or current == ARGV[i + 1] then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 2])
+    end
+end
+return 0
+"""
+
+# Returns the size of the result of set command ARGV[1] (SINTER, SUNION or
+# SDIFF) over KEYS without sending the members back.
+SETOP_CARD_SCRIPT = """
+return #redis.call(ARGV[1], unpack(KEYS))
+"""
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+def tombstone():
+    return 'RedisObjects:deleted:{}'.format(uuid4().hex)
+
+# Stored in place of a nested value, followed by the name of its child key.
+NESTED_PREFIX = 'RedisObjects:nested:'
+
+class PickleCodec(object):
+    """Pickles with cPickle by default. Pass module=pickle to get the exact
+    bytes the pure Python pickle writes, which number memo entries differently.
+    """
+    def __init__(self, protocol=pickle.HIGHEST_PROTOCOL, module=cPickle):
+        self.protocol = protocol
+        self.module = module
+
+    def dumps(self, value):
+        return self.module.dumps(value, self.protocol)
+
+    def loads(self, value):
+        return cPickle.loads(value)
+
+class RawCodec(object):
+    """Stores str values as they are and unicode as UTF-8, so other clients
+    can read them and MATCH patterns work on keys.
+    """
+    def dumps(self, value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if not isinstance(value, str):
+            raise TypeError('RawCodec can only store str or unicode (not "{}")'.format(type(value)))
+        return value
+
+    def loads(self, value):
+        return value
+
+class JSONCodec(object):
+    def dumps(self, value):
+        return json.dumps(value, separators=(',', ':'))
+
+    def loads(self, value):
+        return json.loads(value)
+
+class MsgpackCodec(object):
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError('MsgpackCodec requires the msgpack package')
+
+    def dumps(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, value):
+        return msgpack.unpackb(value, raw=False)
+
+class CompressedCodec(object):
+    """Wraps another codec and compresses encodings of at least threshold
+    bytes. A one byte header records whether a value was compressed; pass
+    compress/decompress (e.g. lz4.frame's) to replace zlib.
+    """
+    def __init__(self, codec, threshold=1024, compress=zlib.compress, decompress=zlib.decompress):
+        self.codec = codec
+        self.threshold = threshold
+        self.compress = compress
+        self.decompress = decompress
+
+    def dumps(self, value):
+        encoded = self.codec.dumps(value)
+        if len(encoded) < self.threshold:
+            return '\x00' + encoded
+        return '\x01' + self.compress(encoded)
+
+    def loads(self, value):
+        if value[0] == '\x01':
+            return self.codec.loads(self.decompress(value[1:]))
+        return self.codec.loads(value[1:])
+
+class RedisInstrumentation(object):
+    """Per-object, per-method accounting of the Redis commands, round trips,
+    bytes and time spent by RedisObject methods, handed to each sink as one
+    record per outermost method call (generators report once exhausted).
+    While disabled an instrumented call costs one attribute check.
+    """
+    enabled = False
+    sinks = []
+    local = threading.local()
+
+    @classmethod
+    def enable(cls, *sinks):
+        cls.sinks = list(sinks)
+        cls.enabled = True
+
+    @classmethod
+    def disable(cls):
+        cls.enabled = False
+        cls.sinks = []
+
+    @classmethod
+    def current(cls):
+        if not cls.enabled:
+            return None
+        return getattr(cls.local, 'record', None)
+
+    @classmethod
+    def start(cls, obj, method):
+        """Starts a record for obj.method, or returns None inside another
+        instrumented call, which the work is then attributed to.
+        """
+        if getattr(cls.local, 'record', None) is not None:
+            return None
+        record = {
+            'object': type(obj).__name__,
+            'name': obj.name,
+            'method': method,
+            'commands': 0,
+            'round_trips': 0,
+            'bytes_serialized': 0,
+            'bytes_deserialized': 0,
+            'serialize_seconds': 0.0,
+            'network_seconds': 0.0,
+            'seconds': 0.0,
+            'started': time.time(),
+        }
+        cls.local.record = record
+        return record
+
+    @classmethod
+    def stop(cls, record, emit=True):
+        record['seconds'] += time.time() - record.pop('started')
+        cls.local.record = None
+        if emit:
+            for sink in cls.sinks:
+                sink(record)
+
+    @classmethod
+    def generator(cls, record, generator):
+        try:
+            while True:
+                if getattr(cls.local, 'record', None) is None:
+                    record['started'] = time.time()
+                    cls.local.record = record
+                try:
+                    value = next(generator)
+                except StopIteration:
+                    return
+                finally:
+                    if cls.local.record is record:
+                        cls.stop(record, emit=False)
+                yield value
+        finally:
+            for sink in cls.sinks:
+                sink(record)
 
+    @classmethod
+    def command(cls, record, commands, start):
+        record['commands'] += commands
+        record['round_trips'] += 1
+        record['network_seconds'] += time.time() - start
+
+def instrument(name, method):
+    @wraps(method)
+    def instrumented_method(self, *args, **kwargs):
+        if not RedisInstrumentation.enabled:
+            return method(self, *args, **kwargs)
+        record = RedisInstrumentation.start(self, name)
+        if record is None:
+            return method(self, *args, **kwargs)
+        try:
+            result = method(self, *args, **kwargs)
+        except Exception:
+            RedisInstrumentation.stop(record)
+            raise
+        if isinstance(result, GeneratorType):
+            RedisInstrumentation.stop(record, emit=False)
+            return RedisInstrumentation.generator(record, result)
+        RedisInstrumentation.stop(record)
+        return result
+    return instrumented_method
+
+INSTRUMENTED_SPECIAL_METHODS = ('__getitem__', '__setitem__', '__delitem__', '__contains__', '__iter__', '__len__', '__eq__', '__list__')
+
+def instrumented(cls):
+    """Class decorator that reports the public methods cls defines, plus
+    INSTRUMENTED_SPECIAL_METHODS, to RedisInstrumentation.
+    """
+    for name, method in cls.__dict__.items():
+        if inspect.isfunction(method) and (not name.startswith('_') or name in INSTRUMENTED_SPECIAL_METHODS):
+            setattr(cls, name, instrument(name, method))
+    return cls
+
+class StatsSink(object):
+    """Sums records per (object type, object name, method), with a latency
+    histogram, and renders them in the Prometheus text format. With
+    per_object=False all objects of a type share one entry.
+    """
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, float('inf'))
+    counters = ('calls', 'commands', 'round_trips', 'bytes_serialized', 'bytes_deserialized', 'serialize_seconds', 'network_seconds', 'seconds')
+
+    def __init__(self, per_object=True):
+        self.per_object = per_object
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        key = (record['object'], record['name'] if self.per_object else None, record['method'])
+        with self.lock:
+            if key not in self.stats:
+                self.stats[key] = dict((counter, 0) for counter in self.counters)
+                self.stats[key]['histogram'] = [0] * len(self.buckets)
+            stats = self.stats[key]
+            stats['calls'] += 1
+            for counter in self.counters[1:]:
+                stats[counter] += record[counter]
+            for index, bucket in enumerate(self.buckets):
+                if record['seconds'] <= bucket:
+                    stats['histogram'][index] += 1
+                    break
+
+    def prometheus(self, prefix='redisobjects'):
+        lines = []
+        with self.lock:
+            for (object_type, name, method), stats in sorted(self.stats.items()):
+                labels = 'type="{}",method="{}"'.format(object_type, method)
+                if name is not None:
+                    labels += ',name="{}"'.format(name)
+                for counter in self.counters:
+                    lines.append('{}_{}_total{{{}}} {}'.format(prefix, counter, labels, stats[counter]))
+                cumulative = 0
+                for bucket, count in izip(self.buckets, stats['histogram']):
+                    cumulative += count
+                    lines.append('{}_latency_seconds_bucket{{{},le="{}"}} {}'.format(prefix, labels, '+Inf' if bucket == float('inf') else bucket, cumulative))
+        return '\n'.join(lines) + '\n'
+
+class StatsDSink(object):
+    """Sends each record to a StatsD daemon over UDP as counters and a
+    latency timer named prefix.type[.name].method.metric.
+    """
+    def __init__(self, host='localhost', port=8125, prefix='redisobjects', per_object=False):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.per_object = per_object
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, record):
+        parts = [self.prefix, record['object']]
+        if self.per_object:
+            parts.append(record['name'].replace('.', '_'))
+        parts.append(record['method'].strip('_'))
+        metric = '.'.join(parts)
+        lines = ['{}.{}:{}|c'.format(metric, counter, record[counter]) for counter in ('commands', 'round_trips', 'bytes_serialized', 'bytes_deserialized')]
+        lines.append('{}.latency:{:.3f}|ms'.format(metric, record['seconds'] * 1000))
+        try:
+            self.socket.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        record = RedisInstrumentation.current()
+        if record is None:
+            return super(InstrumentedPipeline, self).execute(raise_on_error)
+        commands = len(self.command_stack) + (2 if self.transaction and self.command_stack else 0)
+        start = time.time()
+        try:
+            return super(InstrumentedPipeline, self).execute(raise_on_error)
+        finally:
+            RedisInstrumentation.command(record, commands, start)
+
+class PinnedConnectionPool(object):
+    """Pool for the pipelines of a client that holds one connection (a
+    thread's client under thread_affinity): it lends them that connection
+    instead of checking out a second one.
+    """
+    def __init__(self, client):
+        self.client = client
+
+    def get_connection(self, command_name, *keys, **options):
+        return self.client.connection
+
+    def release(self, connection):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.client.connection_pool, name)
+
+class RetryingRedis(redis.Redis):
+    """redis.Redis that retries a command with exponential backoff after a
+    ConnectionError instead of pinging the server before every command.
+
+    A command is only resent when the connection failed before it was sent,
+    or when it is read-only: a write or pop whose reply was lost may already
+    have run, and running it again would repeat it.
+    """
+    retries = 3
+    backoff = 0.05
+    max_backoff = 1.0
+    read_only_commands = frozenset([
+        'DUMP', 'EXISTS', 'GET', 'HEXISTS', 'HGET', 'HGETALL', 'HKEYS', 'HLEN', 'HMGET', 'HSCAN', 'HVALS',
+        'LINDEX', 'LLEN', 'LPOS', 'LRANGE', 'PING', 'PTTL', 'SCAN', 'SCARD', 'SDIFF', 'SINTER', 'SISMEMBER',
+        'SMEMBERS', 'SSCAN', 'SUNION', 'TTL', 'TYPE', 'ZCARD', 'ZCOUNT', 'ZRANGE', 'ZRANGEBYLEX',
+        'ZRANGEBYSCORE', 'ZRANK', 'ZREVRANGE', 'ZREVRANGEBYLEX', 'ZREVRANGEBYSCORE', 'ZREVRANK', 'ZSCAN', 'ZSCORE',
+    ])
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pool = self.connection_pool if self.connection is None else PinnedConnectionPool(self)
+        return InstrumentedPipeline(pool, self.response_callbacks, transaction, shard_hint)
+
+    def execute_command(self, *args, **options):
+        record = RedisInstrumentation.current()
+        if record is None:
+            return self._execute_command(*args, **options)
+        start = time.time()
+        try:
+            return self._execute_command(*args, **options)
+        finally:
+            RedisInstrumentation.command(record, 1, start)
+
+    def _execute_command(self, *args, **options):
+        # redis.Redis.execute_command, keeping track of whether the command
+        # reached the socket.
+        command_name = args[0]
+        attempt = 0
+        while True:
+            sent = False
+            connection = None
+            try:
+                connection = self.connection or self.connection_pool.get_connection(command_name, **options)
+                connection.send_command(*args)
+                sent = True
+                return self.parse_response(connection, command_name, **options)
+            except redis.ConnectionError:
+                if connection is not None:
+                    connection.disconnect()
+                if attempt >= self.retries or (sent and command_name.upper() not in self.read_only_commands):
+                    raise
+            finally:
+                if connection is not None and not self.connection:
+                    self.connection_pool.release(connection)
+            time.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+            attempt += 1
 
 class RedisConnectionManager(object):
+    """Hands out one pooled RetryingRedis per connection_key. Clients are
+    created under a lock, and a process forked from one that already had
+    clients starts over with new pools instead of sharing its parent's
+    sockets.
+
+    Two connection options are handled here rather than by the pool:
+    thread_affinity=True gives each thread its own client holding one
+    connection of the pool for as long as the thread lives, so its commands
+    and pipelines skip the pool's lock and each thread needs exactly one
+    connection; pool_timeout=seconds uses a BlockingConnectionPool
+    that waits that long for a free connection once max_connections are in
+    use instead of raising.
+    """
     cons = {}
+    # connection_keys whose clients are per thread.
+    affine = set()
+    lock = threading.Lock()
+    local = threading.local()
+    pid = os.getpid()
+    # Connections idle longer than this many seconds are pinged before reuse.
+    connection_defaults = {'health_check_interval': 30}
 
     @classmethod
     def r(cls, obj):
-        success = False
-        while not success:
-            try:
-                success = cls.cons[(obj.host, obj.port)].ping()
-            except (redis.ConnectionError, KeyError):
-                cls.cons[(obj.host, obj.port)] = redis.Redis(obj.host, obj.port)
-        return cls.cons[(obj.host, obj.port)]
+        key = obj.connection_key
+        if cls.pid != os.getpid():
+            cls._reset()
+        client = cls.cons.get(key) or cls._create(obj, key)
+        if key not in cls.affine:
+            return client
+        clients = cls.local.__dict__.setdefault('cons', {})
+        if key not in clients:
+            clients[key] = RetryingRedis(connection_pool=client.connection_pool, single_connection_client=True)
+        return clients[key]
+
+    @classmethod
+    def _create(cls, obj, key):
+        with cls.lock:
+            if key not in cls.cons:
+                connection_kwargs = dict(cls.connection_defaults)
+                connection_kwargs.update(obj.connection_kwargs)
+                if connection_kwargs.pop('thread_affinity', False):
+                    cls.affine.add(key)
+                pool_timeout = connection_kwargs.pop('pool_timeout', None)
+                if pool_timeout is None:
+                    pool = redis.ConnectionPool(host=obj.host, port=obj.port, db=obj.db, **connection_kwargs)
+                else:
+                    pool = redis.BlockingConnectionPool(host=obj.host, port=obj.port, db=obj.db, timeout=pool_timeout, **connection_kwargs)
+                cls.cons[key] = RetryingRedis(connection_pool=pool)
+            return cls.cons[key]
+
+    @classmethod
+    def _reset(cls):
+        with cls.lock:
+            if cls.pid != os.getpid():
+                for client in cls.local.__dict__.get('cons', {}).values():
+                    # Its connection is the parent's; it must not be released
+                    # into the pool once the client is collected.
+                    client.connection = None
+                cls.cons = {}
+                cls.affine = set()
+                cls.local = threading.local()
+                cls.pid = os.getpid()
 
 class RedisLockInUse(Exception):
     pass
 
-class RedisObject(object):
-    instances = []
+class RedisFutureNotReady(Exception):
+    pass
+
+class RedisTransactionFailed(Exception):
+    pass
+
+class RedisSnapshotError(Exception):
+    pass
 
-    def __init__(self, name, host='localhost', port=6379):
+class RedisLock(object):
+    """Lock on SET NX PX with a random token, so only its holder can release
+    or extend it and it expires after ttl seconds if the holder dies.
+    Blocked acquires retry with exponential backoff between backoff and
+    max_backoff seconds. Contention counts are added to stats.
+    """
+    held = set()
+
+    def __init__(self, obj, ttl=30, backoff=0.005, max_backoff=0.5, stats=None):
+        self.obj = obj
+        self.ttl = ttl
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.token = None
+        if stats is None:
+            stats = {'acquired': 0, 'contended': 0, 'attempts': 0, 'timeouts': 0, 'wait_seconds': 0.0}
+        self.stats = stats
+
+    @property
+    def r(self):
+        return RedisConnectionManager.r(self.obj)
+
+    def acquire(self, blocking=True, timeout=None):
+        token = uuid4().hex
+        start = time.time()
+        delay = self.backoff
+        attempts = 0
+        while True:
+            attempts += 1
+            self.stats['attempts'] += 1
+            if self.r.set(self.obj.lock_name, token, nx=True, px=int(self.ttl * 1000)):
+                self.token = token
+                self.held.add(self)
+                self.stats['acquired'] += 1
+                self.stats['wait_seconds'] += time.time() - start
+                return True
+            if attempts == 1:
+                self.stats['contended'] += 1
+            waited = time.time() - start
+            if not blocking or (timeout is not None and waited >= timeout):
+                self.stats['timeouts'] += 1
+                self.stats['wait_seconds'] += waited
+                return False
+            if timeout is not None:
+                delay = min(delay, timeout - waited)
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+    def release(self):
+        if self.token is None:
+            return False
+        released = self.obj._script(LOCK_RELEASE_SCRIPT)(keys=[self.obj.lock_name], args=[self.token], client=self.r)
+        self.token = None
+        self.held.discard(self)
+        return bool(released)
+
+    def extend(self, ttl=None):
+        """Restarts the expiry at ttl (default self.ttl) seconds; False if
+        the lock was lost in the meantime.
+        """
+        if self.token is None:
+            return False
+        ttl = self.ttl if ttl is None else ttl
+        return bool(self.obj._script(LOCK_EXTEND_SCRIPT)(keys=[self.obj.lock_name], args=[self.token, int(ttl * 1000)], client=self.r))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+class RedisFuture(object):
+    """Deferred result of a read issued inside a batch, available once the
+    batch has been sent.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self.ready = False
+        self._value = None
+        self._exception = None
+
+    def resolve(self, response):
+        try:
+            self._value = self.callback(response)
+        except Exception as exception:
+            self._exception = exception
+        self.ready = True
+
+    def result(self):
+        if not self.ready:
+            raise RedisFutureNotReady('Result is only available once the batch has been sent')
+        if self._exception is not None:
+            raise self._exception
+        return self._value
+
+class RedisBatch(object):
+    """Queues the commands of one or more RedisObjects onto a single pipeline
+    that is sent in one round trip when the with block exits.
+    """
+    def __init__(self, objs, transaction=False):
+        if len(set(obj.connection_key for obj in objs)) != 1:
+            raise ValueError('All objects in a batch must share one connection')
+        self.objs = objs
+        self.pipe = objs[0].r.pipeline(transaction)
+        self.futures = {}
+        self.invalidations = []
+
+    @property
+    def immediate(self):
+        # A pipeline watching keys runs commands right away until MULTI.
+        return self.pipe.watching and not self.pipe.explicit_transaction
+
+    def writer(self):
+        if self.immediate:
+            self.pipe.multi()
+        return self.pipe
+
+    def defer(self, callback, index=None):
+        future = RedisFuture(callback)
+        if index is None:
+            index = len(self.pipe.command_stack) - 1
+        self.futures[index] = future
+        return future
+
+    def __enter__(self):
+        for obj in self.objs:
+            obj._batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for obj in self.objs:
+            obj._batch = None
+        if exc_type is not None:
+            self.pipe.reset()
+            return
+        record = RedisInstrumentation.enabled and RedisInstrumentation.start(self.objs[0], 'batch')
+        try:
+            responses = self.pipe.execute()
+        finally:
+            if record:
+                RedisInstrumentation.stop(record)
+        for obj, fields in self.invalidations:
+            obj._invalidate(fields)
+        for index, response in enumerate(responses):
+            if index in self.futures:
+                self.futures[index].resolve(response)
+
+def pipeline(*objs, **kwargs):
+    return RedisBatch(objs, kwargs.get('transaction', False))
+
+class RedisTransaction(RedisBatch):
+    """One attempt of an optimistic transaction over objs: their keys are
+    WATCHed, reads run right away, writes are queued and sent in one MULTI
+    when the with block exits. If another client changed a watched key the
+    writes are dropped and committed stays False.
+    """
+    def __init__(self, objs):
+        super(RedisTransaction, self).__init__(objs, True)
+        self.committed = False
+        self.pipe.watch(*[obj.name for obj in objs])
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            super(RedisTransaction, self).__exit__(exc_type, exc_value, traceback)
+        except redis.WatchError:
+            return True
+        finally:
+            self.pipe.reset()
+        self.committed = exc_type is None
+
+def transaction(*objs, **kwargs):
+    """Yields RedisTransaction attempts over objs until one commits:
+
+        for attempt in transaction(rd):
+            with attempt:
+                rd['count'] = rd['count'] + 1
+
+    Raises RedisTransactionFailed after retries attempts that lost a race.
+    """
+    retries = kwargs.get('retries', 10)
+    for _ in xrange(retries):
+        attempt = RedisTransaction(objs)
+        yield attempt
+        if attempt.committed:
+            return
+    raise RedisTransactionFailed('Keys of {} kept changing'.format(', '.join(obj.name for obj in objs)))
+
+# A snapshot is SNAPSHOT_HEADER followed by frames: a one byte tag, an 8 byte
+# big endian length and the payload. Each key is a KEY frame (kind,
+# milliseconds to live or -1, name), ENTRIES frames of at most chunk_size
+# length prefixed strings or one DUMP frame, then an END frame, so readers
+# never hold more than one frame.
+SNAPSHOT_HEADER = 'RedisObjects snapshot 1\n'
+SNAPSHOT_KEY, SNAPSHOT_ENTRIES, SNAPSHOT_DUMP, SNAPSHOT_END = 'K', 'E', 'D', 'X'
+SNAPSHOT_KINDS = ('string', 'list', 'hash', 'set', 'zset')
+SNAPSHOT_BUFFER = 2 ** 20
+FRAME = struct.Struct('>cQ')
+LENGTH = struct.Struct('>I')
+
+def pack_strings(strings):
+    return ''.join(LENGTH.pack(len(string)) + string for string in strings)
+
+def unpack_strings(payload):
+    strings = []
+    offset, end = 0, len(payload)
+    while offset < end:
+        length, = LENGTH.unpack_from(payload, offset)
+        offset += LENGTH.size
+        strings.append(payload[offset:offset + length])
+        offset += length
+    return strings
+
+@contextmanager
+def snapshot_file(path, mode):
+    # Open file objects are used as they are and left open.
+    if hasattr(path, 'read' if mode == 'r' else 'write'):
+        yield path
+        return
+    with open(path, mode + 'b', SNAPSHOT_BUFFER) as stream:
+        yield stream
+
+def write_frame(stream, tag, payload=''):
+    stream.write(FRAME.pack(tag, len(payload)))
+    stream.write(payload)
+
+def read_frames(stream):
+    if stream.read(len(SNAPSHOT_HEADER)) != SNAPSHOT_HEADER:
+        raise RedisSnapshotError('Not a RedisObjects snapshot')
+    while True:
+        header = stream.read(FRAME.size)
+        if not header:
+            return
+        if len(header) < FRAME.size:
+            raise RedisSnapshotError('Snapshot is truncated')
+        tag, length = FRAME.unpack(header)
+        payload = stream.read(length)
+        if len(payload) < length:
+            raise RedisSnapshotError('Snapshot is truncated')
+        yield tag, payload
+
+def scan_chunks(client, name, kind, chunk_size):
+    if kind == 'string':
+        yield [client.get(name)]
+    elif kind == 'list':
+        for start in count(0, chunk_size):
+            values = client.lrange(name, start, start + chunk_size - 1)
+            if values:
+                yield values
+            if len(values) < chunk_size:
+                return
+    elif kind == 'hash':
+        for pairs in chunked(client.hscan_iter(name, count=chunk_size), chunk_size):
+            yield list(chain.from_iterable(pairs))
+    elif kind == 'set':
+        for members in chunked(client.sscan_iter(name, count=chunk_size), chunk_size):
+            yield members
+    elif kind == 'zset':
+        for pairs in chunked(client.zscan_iter(name, count=chunk_size), chunk_size):
+            yield list(chain.from_iterable((member, repr(score)) for member, score in pairs))
+
+def restore_chunk(pipe, name, kind, values):
+    if kind == 'string':
+        pipe.set(name, values[0])
+    elif kind == 'list':
+        pipe.rpush(name, *values)
+    elif kind == 'hash':
+        pipe.hset(name, mapping=dict(izip(values[::2], values[1::2])))
+    elif kind == 'set':
+        pipe.sadd(name, *values)
+    elif kind == 'zset':
+        pipe.zadd(name, dict(izip(values[::2], values[1::2])))
+
+def dump_key(stream, client, name, exact=False, chunk_size=1000):
+    """Writes the key name to stream, returning False when it does not exist.
+
+    Entries are read chunk_size at a time with LRANGE or SCAN, so a key
+    written to meanwhile is not captured at one point in time (scans may
+    also repeat entries, which restoring a hash, set or sorted set absorbs).
+    exact takes a byte exact DUMP in one MULTI with the expiry instead, at
+    the cost of holding the whole serialized key in memory.
+    """
+    pipe = client.pipeline(True)
+    pipe.type(name)
+    pipe.pttl(name)
+    if exact:
+        pipe.dump(name)
+    responses = pipe.execute()
+    kind, ttl = responses[0], responses[1]
+    if kind == 'none':
+        return False
+    if not exact and kind not in SNAPSHOT_KINDS:
+        raise RedisSnapshotError('Cannot snapshot {} key {} without exact=True'.format(kind, name))
+    write_frame(stream, SNAPSHOT_KEY, pack_strings(['dump' if exact else kind, str(ttl), name]))
+    if exact:
+        write_frame(stream, SNAPSHOT_DUMP, responses[2])
+    else:
+        for values in scan_chunks(client, name, kind, chunk_size):
+            write_frame(stream, SNAPSHOT_ENTRIES, pack_strings(values))
+    write_frame(stream, SNAPSHOT_END)
+    return True
+
+def restore_keys(stream, target, depth=100):
+    """Restores the keys of a snapshot stream. target(name) returns the
+    object to restore the key saved under name into, or None to skip it.
+
+    Each key is rebuilt under a temporary name with up to depth chunks in
+    flight per round trip, then renamed over the object's key, so readers
+    see either the old value or the complete new one. Returns the objects
+    restored, in order.
+    """
+    restored = []
+    pipe = obj = None
+    try:
+        for tag, payload in read_frames(stream):
+            if tag == SNAPSHOT_KEY:
+                kind, ttl, name = unpack_strings(payload)
+                obj = target(name)
+                if obj is not None:
+                    pipe = RedisConnectionManager.r(obj).pipeline(False)
+                    loading = '{}:loading:{}'.format(obj.name, uuid4().hex)
+                    written = False
+            elif pipe is None:
+                continue
+            elif tag == SNAPSHOT_ENTRIES:
+                restore_chunk(pipe, loading, kind, unpack_strings(payload))
+                written = True
+                if len(pipe.command_stack) >= depth:
+                    pipe.execute()
+            elif tag == SNAPSHOT_DUMP:
+                pipe.restore(loading, 0, payload, replace=True)
+                written = True
+            elif tag == SNAPSHOT_END:
+                if written:
+                    pipe.rename(loading, obj.name)
+                else:
+                    pipe.delete(obj.name)
+                if int(ttl) > 0:
+                    pipe.pexpire(obj.name, int(ttl))
+                elif obj.expiry is not None:
+                    pipe.pexpire(obj.name, int(obj.expiry * 1000))
+                if obj.versioned:
+                    pipe.incr(obj.version_name)
+                pipe.execute()
+                obj._invalidate()
+                restored.append(obj)
+                pipe = None
+        if pipe is not None:
+            raise RedisSnapshotError('Snapshot ends inside key {}'.format(name))
+    except BaseException:
+        if pipe is not None:
+            pipe.reset()
+            RedisConnectionManager.r(obj).delete(loading)
+        raise
+    return restored
+
+def dump(path, *objs, **kwargs):
+    """Streams the keys of objs to a snapshot at path (a file name or a file
+    opened for binary writing), each followed by the keys of its nested
+    children. Keys that do not exist are left out; returns the number
+    written. kwargs exact and chunk_size are passed to dump_key.
+    """
+    written = 0
+    with snapshot_file(path, 'w') as stream:
+        stream.write(SNAPSHOT_HEADER)
+        for obj in objs:
+            written += dump_key(stream, RedisConnectionManager.r(obj), obj.name, **kwargs)
+            for child in obj._snapshot_children():
+                written += dump_key(stream, RedisConnectionManager.r(child), child.name, **kwargs)
+    return written
+
+def load(path, *objs, **kwargs):
+    """Restores each key of the snapshot at path into the one of objs with
+    the same name, or the nested child of one of them it names, skipping
+    the others. Returns the objects restored; kwarg depth is passed to
+    restore_keys.
+    """
+    by_name = dict((obj.name, obj) for obj in objs)
+    def target(name):
+        if name in by_name:
+            return by_name[name]
+        for obj in objs:
+            child = obj._snapshot_child(name)
+            if child is not None:
+                return child
+    with snapshot_file(path, 'r') as stream:
+        return restore_keys(stream, target, **kwargs)
+
+class RedisCache(object):
+    """Client-side LRU cache of the encoded replies read by RedisObjects,
+    bounded by entry count and optionally by total bytes and entry age.
+    Pass one as cache= to any number of RedisObjects.
+
+    invalidation chooses how writes made by other clients are noticed:
+    'version' compares each object's version counter with the server at most
+    every check_interval seconds, which only notices writes made through
+    objects that bump it (cached in 'version' mode); 'tracking' has the server push
+    invalidations with CLIENT TRACKING in broadcast mode, for keys starting
+    with one of prefixes (all keys when empty); 'keyspace' listens to
+    keyspace notifications, which must be enabled with notify-keyspace-events.
+    If a listener connection drops, the listener stops and writes by other
+    clients go unnoticed. Writes made through a cached object always drop
+    its local entries. Entries are kept per server, db and key name, so
+    objects with the same name on different connections do not share them.
+    """
+    def __init__(self, max_entries=1024, max_bytes=None, ttl=None, invalidation='version', check_interval=1.0, prefixes=()):
+        if invalidation not in ('version', 'tracking', 'keyspace'):
+            raise ValueError('Unknown invalidation "{}"'.format(invalidation))
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.invalidation = invalidation
+        self.check_interval = check_interval
+        self.prefixes = prefixes
+        self.entries = OrderedDict()
+        self.fields = defaultdict(set)
+        self.generations = defaultdict(int)
+        self.versions = {}
+        self.listeners = {}
+        self.size = 0
+        self.lock = threading.RLock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def watch(self, obj):
+        if self.invalidation == 'tracking':
+            self._track(obj)
+        elif self.invalidation == 'keyspace':
+            self._listen(obj)
+
+    @staticmethod
+    def key(obj):
+        return (obj.connection_key, obj.name)
+
+    def fetch(self, obj, field, loader):
+        """Returns the cached reply for field of obj, calling loader on a miss."""
+        if self.invalidation == 'version':
+            self._check_version(obj)
+        name = self.key(obj)
+        key = (name, field)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and (entry[0] is None or entry[0] > time.time()):
+                self.entries[key] = entry
+                self.stats['hits'] += 1
+                return entry[2]
+            if entry is not None:
+                self.size -= entry[1]
+            self.stats['misses'] += 1
+            generation = self.generations[name]
+        value = loader()
+        with self.lock:
+            # Anything invalidated while loading may have been read stale.
+            if self.generations[name] == generation:
+                self._store(key, value)
+        return value
+
+    def fetch_many(self, obj, fields, loader):
+        """Returns the cached replies for fields of obj in order, calling
+        loader once with the list of missed fields for their replies.
+        """
+        if self.invalidation == 'version':
+            self._check_version(obj)
+        name = self.key(obj)
+        replies = [None] * len(fields)
+        missed = []
+        now = time.time()
+        with self.lock:
+            for position, field in enumerate(fields):
+                key = (name, field)
+                entry = self.entries.pop(key, None)
+                if entry is not None and (entry[0] is None or entry[0] > now):
+                    self.entries[key] = entry
+                    self.stats['hits'] += 1
+                    replies[position] = entry[2]
+                    continue
+                if entry is not None:
+                    self.size -= entry[1]
+                self.stats['misses'] += 1
+                missed.append(position)
+            generation = self.generations[name]
+        if not missed:
+            return replies
+        values = loader([fields[position] for position in missed])
+        with self.lock:
+            store = self.generations[name] == generation
+            for position, value in izip(missed, values):
+                replies[position] = value
+                if store:
+                    self._store((name, fields[position]), value)
+        return replies
+
+    def invalidate(self, name, fields=None):
+        """Drops the entries for fields (all when None) of name, a key(obj)."""
+        with self.lock:
+            self.generations[name] += 1
+            self.stats['invalidations'] += 1
+            for field in list(self.fields[name]) if fields is None else fields:
+                self._discard((name, field))
+
+    def close(self):
+        """Stops the invalidation listeners."""
+        with self.lock:
+            listeners = self.listeners.values()
+            self.listeners.clear()
+        # Joined outside the lock, which the listener threads' handlers take.
+        # Each worker thread closes its pubsub once it has stopped.
+        for listener in listeners:
+            listener[1].stop()
+            listener[1].join()
+            if len(listener) > 2:
+                listener[2].disconnect()
+
+    def clear(self, connection_key=None):
+        """Drops every entry, or only those of objects on connection_key."""
+        with self.lock:
+            if connection_key is not None:
+                for name in [name for name in self.generations if name[0] == connection_key]:
+                    self.invalidate(name)
+                return
+            for name in list(self.generations):
+                self.generations[name] += 1
+            self.entries.clear()
+            self.fields.clear()
+            self.size = 0
+
+    def _store(self, key, value):
+        self._discard(key)
+        if value is None:
+            size = 0
+        elif type(value) is list:
+            size = sum(len(item) for item in value)
+        else:
+            size = len(value)
+        expires = None if self.ttl is None else time.time() + self.ttl
+        self.entries[key] = (expires, size, value)
+        self.fields[key[0]].add(key[1])
+        self.size += size
+        while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+            self._discard(next(iter(self.entries)))
+            self.stats['evictions'] += 1
+
+    def _discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+            self.fields[key[0]].discard(key[1])
+
+    def _check_version(self, obj):
+        name = self.key(obj)
+        version, checked = self.versions.get(name, (None, 0))
+        now = time.time()
+        if now - checked < self.check_interval:
+            return
+        current = RedisConnectionManager.r(obj).get(obj.version_name)
+        if current != version:
+            self.invalidate(name)
+        self.versions[name] = (current, now)
+
+    def _on_invalidate(self, connection_key, message):
+        if message['data'] is None:
+            self.clear(connection_key)
+            return
+        for name in message['data']:
+            self.invalidate((connection_key, name))
+
+    def _on_keyspace(self, connection_key, message):
+        self.invalidate((connection_key, message['channel'].split(':', 1)[1]))
+
+    def _track(self, obj):
+        with self.lock:
+            if obj.connection_key in self.listeners:
+                return
+            client = RedisConnectionManager.r(obj)
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            # The listener's id is needed for REDIRECT, and CLIENT ID cannot
+            # be sent once the connection is subscribed.
+            pubsub.connection = client.connection_pool.get_connection('pubsub')
+            pubsub.connection.register_connect_callback(pubsub.on_connect)
+            pubsub.connection.send_command('CLIENT', 'ID')
+            client_id = pubsub.connection.read_response()
+            pubsub.subscribe(**{'__redis__:invalidate': partial(self._on_invalidate, obj.connection_key)})
+            # Tracking lasts as long as the connection that enabled it, so it
+            # is kept out of the pool.
+            tracking = client.connection_pool.get_connection('CLIENT')
+            prefixes = []
+            for prefix in self.prefixes:
+                prefixes.extend(['PREFIX', prefix])
+            tracking.send_command('CLIENT', 'TRACKING', 'on', 'REDIRECT', client_id, 'BCAST', *prefixes)
+            tracking.read_response()
+            self.listeners[obj.connection_key] = (pubsub, pubsub.run_in_thread(sleep_time=1, daemon=True), tracking)
+
+    def _listen(self, obj):
+        with self.lock:
+            channel = '__keyspace@{}__:{}'.format(obj.db, obj.name)
+            if obj.connection_key in self.listeners:
+                self.listeners[obj.connection_key][0].subscribe(**{channel: partial(self._on_keyspace, obj.connection_key)})
+                return
+            pubsub = RedisConnectionManager.r(obj).pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{channel: partial(self._on_keyspace, obj.connection_key)})
+            self.listeners[obj.connection_key] = (pubsub, pubsub.run_in_thread(sleep_time=1, daemon=True))
+
+def key_deleter(client, name):
+    def delete(ref):
+        RedisObject.collectors.discard(ref)
+        client.delete(name)
+    return delete
+
+class RedisObject(object):
+    """Handle on one Redis key. Handles do not own the key: collecting one
+    leaves the data alone unless it was created with delete_on_collect.
+
+    With ttl (seconds) every write also resets the key's expiry; with
+    sliding as well, reads push it back too, at most once per
+    sliding_resolution of ttl, so idle objects age out server-side.
+    """
+    instances = weakref.WeakSet()
+    # Weak references whose callbacks delete the key of a collected handle.
+    collectors = set()
+    sliding_resolution = 0.1
+    scripts = {}
+    # Byte for byte what earlier versions wrote with pickle.dumps, so existing
+    # hash fields and list values stay addressable. Assign other codecs here
+    # to change the default globally or pass key_codec/value_codec per object.
+    key_codec = PickleCodec(0, pickle)
+    value_codec = PickleCodec(0, pickle)
+    cache = None
+    _batch = None
+
+    def __init__(self, name, host='localhost', port=6379, db=0, key_codec=None, value_codec=None, cache=None, versioned=False, ttl=None, sliding=False, delete_on_collect=False, **connection_kwargs):
         self.name = name
         self.host = host
         self.port = port
-        self.instances.append(self)
+        self.db = db
+        if key_codec is not None:
+            self.key_codec = key_codec
+        if value_codec is not None:
+            self.value_codec = value_codec
+        self.connection_kwargs = connection_kwargs
+        self._versioned = versioned
+        self.expiry = ttl
+        self.sliding = sliding and ttl is not None
+        self._touched = 0
+        self.lock_stats = {'acquired': 0, 'contended': 0, 'attempts': 0, 'timeouts': 0, 'wait_seconds': 0.0}
+        self.instances.add(self)
+        if delete_on_collect:
+            self.collectors.add(weakref.ref(self, key_deleter(RedisConnectionManager.r(self), name)))
+        if cache is not None:
+            self.cache = cache
+            cache.watch(self)
+
+    @property
+    def connection_key(self):
+        return (self.host, self.port, self.db, tuple(sorted(self.connection_kwargs.items())))
 
     @property
     def r(self):
+        if self._batch is not None:
+            return self._batch.pipe
+        client = RedisConnectionManager.r(self)
+        if self.sliding and time.time() - self._touched >= self.expiry * self.sliding_resolution:
+            self._touched = time.time()
+            client.pexpire(self.name, int(self.expiry * 1000))
+        return client
+
+    @property
+    def _streaming(self):
+        # Scans and paged reads need each reply before sending the next
+        # command, so inside a batch they run right away on the connection
+        # and do not see the batch's queued writes.
+        if self._batch is None:
+            return self.r
         return RedisConnectionManager.r(self)
 
+    def expire(self, seconds):
+        """Expires the key after seconds; False when it does not exist."""
+        return self._deferred(self.r.pexpire(self.name, int(seconds * 1000)), bool)
+
+    def ttl(self):
+        """Seconds until the key expires, or None when it has no expiry."""
+        return self._deferred(self.r.pttl(self.name), lambda milliseconds: milliseconds / 1000.0 if milliseconds >= 0 else None)
+
+    def persist(self):
+        return self._deferred(self.r.persist(self.name), bool)
+
+    def batch(self, transaction=False):
+        return RedisBatch([self], transaction)
+
+    def transaction(self, retries=10):
+        return transaction(self, retries=retries)
+
+    def dump(self, path, exact=False, chunk_size=1000):
+        """Writes the key to a snapshot at path; False when it does not exist."""
+        return bool(dump(path, self, exact=exact, chunk_size=chunk_size))
+
+    def load(self, path, depth=100):
+        """Replaces the key with the first one in the snapshot at path,
+        whatever name it was saved under, along with its nested children.
+        A nested RedisDict only loads a snapshot saved under its own name,
+        since its children are named after it.
+        """
+        names = []
+        def first(name):
+            names.append(name)
+            if len(names) > 1:
+                return self._snapshot_child(name)
+            if name != self.name and getattr(self, 'nested', False):
+                raise RedisSnapshotError('Nested {} cannot be loaded from a snapshot of {}'.format(self.name, name))
+            return self
+        with snapshot_file(path, 'r') as stream:
+            restored = restore_keys(stream, first, depth)
+        if not restored:
+            raise RedisSnapshotError('Snapshot is empty')
+
+    def _snapshot_children(self):
+        # Objects stored under keys of their own that dump writes after this one.
+        return ()
+
+    def _snapshot_child(self, name):
+        # The object to restore the key name saved after this one into, if any.
+        return None
+
+    def _deferred(self, response, callback):
+        if self._batch is None or self._batch.immediate:
+            return callback(response)
+        return self._batch.defer(callback)
+
+    def _resolved(self, response, callback):
+        # For calls answered without a command, so none is queued on a batch.
+        if self._batch is None or self._batch.immediate:
+            return callback(response)
+        future = RedisFuture(callback)
+        future.resolve(response)
+        return future
+
+    @property
+    def version_name(self):
+        return '{}VERSION'.format(self.name)
+
+    @property
+    def versioned(self):
+        return self._versioned or (self.cache is not None and self.cache.invalidation == 'version')
+
+    @property
+    def version(self):
+        """Number of writes made through versioned objects to this one."""
+        return self._deferred(self.r.get(self.version_name), lambda version: int(version or 0))
+
+    def changed_since(self, version):
+        return self._deferred(self.r.get(self.version_name), lambda current: int(current or 0) != version)
+
+    @property
+    def _caching(self):
+        return self.cache is not None and self._batch is None
+
+    def _invalidate(self, fields=None):
+        if self.cache is not None:
+            self.cache.invalidate(self.cache.key(self), fields)
+
+    def _write(self, command, fields=None, callback=None, transaction=None, blocking=False):
+        """Runs command(client) and drops the locally cached entries for
+        fields, or all of this object's entries when fields is None.
+
+        The command is queued on the active batch, or for versioned objects
+        sent in one MULTI with the version bump. Passing transaction gives it
+        a pipeline of its own in any case. Blocking commands would not wait
+        inside MULTI, so with blocking the version bump and expiry follow
+        them on a plain pipeline instead. Returns callback applied to the
+        reply of the first command queued.
+        """
+        callback = callback or (lambda response: response)
+        if self._batch is None and not self.versioned and transaction is None and self.expiry is None:
+            response = command(RedisConnectionManager.r(self))
+            self._invalidate(fields)
+            return callback(response)
+        if self._batch is not None:
+            pipe = self._batch.writer()
+        else:
+            pipe = RedisConnectionManager.r(self).pipeline(not blocking and bool(self.versioned or transaction))
+        index = len(pipe.command_stack)
+        command(pipe)
+        if self.versioned:
+            pipe.incr(self.version_name)
+        if self.expiry is not None:
+            pipe.pexpire(self.name, int(self.expiry * 1000))
+            self._touched = time.time()
+        self._invalidate(fields)
+        if self._batch is not None:
+            self._batch.invalidations.append((self, fields))
+            return self._batch.defer(callback, index)
+        responses = pipe.execute()
+        self._invalidate(fields)
+        if index < len(responses):
+            return callback(responses[index])
+
+    def _script(self, source):
+        # Script objects run with EVALSHA and only fall back to loading the
+        # source when the server does not have it cached yet.
+        if source not in self.scripts:
+            self.scripts[source] = RedisConnectionManager.r(self).register_script(source)
+        return self.scripts[source]
+
     @property
     def lock_name(self):
         return '{}LOCK'.format(self.name)
 
-    def __del__(self):
-        self.r.delete(self.name)
-
     def delete_lock(self):
         self.r.delete(self.lock_name)
 
+    def lock(self, ttl=30):
+        return RedisLock(self, ttl, stats=self.lock_stats)
+
     @contextmanager
-    def acquire_lock(self, raise_exception=False):
-        while self.r.incr(self.lock_name) != 1:
-            self.r.decr(self.lock_name)
-            if raise_exception:
-                raise RedisLockInUse('Cannot acquire lock for {}'.format(self.name))
-        yield
-        if self.r.exists(self.lock_name):
-            self.r.decr(self.lock_name)
+    def acquire_lock(self, raise_exception=False, timeout=None, ttl=30):
+        """Holds the lock for the with block, yielding the RedisLock so long
+        critical sections can extend() it. Raises RedisLockInUse right away
+        when raise_exception is set, or once timeout seconds have passed.
+        """
+        lock = self.lock(ttl)
+        if not lock.acquire(not raise_exception, timeout):
+            raise RedisLockInUse('Cannot acquire lock for {}'.format(self.name))
+        try:
+            yield lock
+        finally:
+            lock.release()
 
     @classmethod
     def cleanup(cls):
-        for instance in cls.instances:
-            instance.delete_lock()
+        for lock in list(RedisLock.held):
+            lock.release()
+
+    def _encode(self, codec, value):
+        record = RedisInstrumentation.current()
+        if record is None:
+            return codec.dumps(value)
+        start = time.time()
+        encoded = codec.dumps(value)
+        record['serialize_seconds'] += time.time() - start
+        record['bytes_serialized'] += len(encoded)
+        return encoded
+
+    def _decode(self, codec, value):
+        record = RedisInstrumentation.current()
+        if record is None:
+            return codec.loads(value)
+        start = time.time()
+        decoded = codec.loads(value)
+        record['serialize_seconds'] += time.time() - start
+        record['bytes_deserialized'] += len(value)
+        return decoded
 
     def pickle(self, value):
-        return pickle.dumps(value)
+        return self._encode(self.value_codec, value)
 
     def unpickle(self, value):
-        return pickle.loads(value)
+        return self._decode(self.value_codec, value)
+
+    def pickle_key(self, key):
+        return self._encode(self.key_codec, key)
+
+    def unpickle_key(self, key):
+        return self._decode(self.key_codec, key)
 
+@instrumented
 class RedisDict(RedisObject):
+    """Hash of encoded keys to encoded values.
+
+    With nested=True, dict, list and set values are stored as a child
+    RedisDict (nested itself), RedisList or RedisSet under their own key, and
+    the field only holds a reference to it. Reading such a field returns the
+    child object without fetching it, so changing one inner value rewrites
+    only that child. Overwriting or deleting the field deletes the child.
+    Values whose encoding starts with NESTED_PREFIX, possible with RawCodec,
+    are refused with ValueError.
+    """
+    scan_count = 1000
+    # Fields sent per multi-field HSET by update and set_to.
+    chunk_size = 1000
+    nested_types = ((dict, 'dict'), (list, 'list'), (set, 'set'))
+
+    def __init__(self, name, *args, **kwargs):
+        self.nested = kwargs.pop('nested', False)
+        super(RedisDict, self).__init__(name, *args, **kwargs)
+
+    def _child(self, name):
+        kind = name.rsplit(':', 2)[1]
+        kwargs = dict(self.connection_kwargs, key_codec=self.key_codec, value_codec=self.value_codec, versioned=self._versioned, ttl=self.expiry, sliding=self.sliding)
+        if kind == 'dict':
+            return RedisDict(name, self.host, self.port, self.db, nested=True, **kwargs)
+        return {'list': RedisList, 'set': RedisSet}[kind](name, self.host, self.port, self.db, **kwargs)
+
+    def pickle(self, value):
+        if self.nested:
+            # Handles, such as the children read from another field, are
+            # copied by value. The copy is made before the write drops the
+            # replaced child, so assigning a field to itself keeps its data.
+            value = self._materialize(value)
+            for nested_type, kind in self.nested_types:
+                if isinstance(value, nested_type):
+                    # Written before the reference to it, under a fresh name
+                    # so readers of the old reference keep a whole value.
+                    child = self._child('{}:{}:{}'.format(self.name, kind, uuid4().hex))
+                    if kind == 'list':
+                        child.extend(value)
+                    else:
+                        child.update(value)
+                    return NESTED_PREFIX + child.name
+            encoded = super(RedisDict, self).pickle(value)
+            if encoded.startswith(NESTED_PREFIX):
+                raise ValueError('{!r} is encoded like a reference to a nested object'.format(value))
+            return encoded
+        return super(RedisDict, self).pickle(value)
+
+    def _is_reference(self, value):
+        # Children are always named under their parent.
+        return value.startswith(NESTED_PREFIX) and value.startswith('{}:'.format(self.name), len(NESTED_PREFIX))
+
+    def unpickle(self, value):
+        if self.nested and self._is_reference(value):
+            return self._child(value[len(NESTED_PREFIX):])
+        return super(RedisDict, self).unpickle(value)
+
+    def _materialize(self, value):
+        if isinstance(value, RedisDict):
+            return dict((key, value._materialize(item)) for key, item in value.items())
+        if isinstance(value, RedisList):
+            return list(value)
+        if isinstance(value, RedisSet):
+            return value.members()
+        return value
+
+    def _snapshot_children(self):
+        if not self.nested:
+            return
+        for key, value in self.scan():
+            if self._is_reference(value):
+                child = self._child(value[len(NESTED_PREFIX):])
+                yield child
+                if isinstance(child, RedisDict):
+                    for descendant in child._snapshot_children():
+                        yield descendant
+
+    def _snapshot_child(self, name):
+        if self.nested and name.startswith('{}:'.format(self.name)):
+            return self._child(name)
+
+    def _drop_nested(self, client, fields=None, delete=False):
+        return self._script(NESTED_DROP_SCRIPT)(keys=[self.name], args=[NESTED_PREFIX, int(delete)] + list(fields or ()), client=client)
+
     def clear(self):
-        self.r.delete(self.name)
+        if self.nested:
+            self._write(lambda client: self._drop_nested(client, delete=True))
+            return
+        self._write(lambda client: client.delete(self.name))
 
     def pop(self, key, default=None):
-        value = self.__getitem__(key)
+        value = self._materialize(self.__getitem__(key))
         self.__delitem__(key)
         return value or default
 
     def popitem(self):
         key = self.keys()[0]
-        value = self.__getitem__(key)
+        value = self._materialize(self.__getitem__(key))
         self.__delitem__(key)
         return key, value
 
     def set_to(self, py_dict):
-        self.r.delete(self.name)
-        self.update(py_dict)
+        # Built under a temporary key and renamed over the original, so
+        # readers see either the old or the new contents but never neither.
+        temp_name = '{}:set_to:{}'.format(self.name, uuid4().hex)
+        def replace(pipe):
+            if self.nested:
+                self._drop_nested(pipe)
+            if self._hset_items(pipe, temp_name, py_dict, {}):
+                pipe.rename(temp_name, self.name)
+            else:
+                pipe.delete(self.name)
+        self._write(replace, transaction=self.nested)
 
     def setdefault(self, key, default=None):
         value = self.__getitem__(key)
@@ -94,61 +1732,173 @@ class RedisDict(RedisObject):
         return default
 
     def get(self, key, default=None):
-        pickled_value = self.r.hget(self.name, self.pickle(key))
-        if pickled_value is None:
-            if default is not None:
+        def unpickle_value(pickled_value):
+            if pickled_value is None and default is not None:
                 return default
-            raise KeyError('Key "{}" is not valid'.format(key))
-        return self.unpickle(pickled_value)
-
-    def update(self, obj, **kwargs):
-        for key, value in kwargs.iteritems():
-            self.__setitem__(key, value)
-        if type(obj) in (dict, RedisDict):
-            for key, value in obj.iteritems():
-                self.__setitem__(key, value)
-        if type(obj) is list:
-            for key, value in obj:
-                self.__setitem__(key, value)
-
-    def iterkeys(self):
-        return self.__iter__()
+            return self._unpickle_value(key, pickled_value)
+        return self._deferred(self._hget(self.pickle_key(key)), unpickle_value)
+
+    def _hget(self, field):
+        if not self._caching:
+            return self.r.hget(self.name, field)
+        return self.cache.fetch(self, field, lambda: RedisConnectionManager.r(self).hget(self.name, field))
+
+    def _hmget(self, fields):
+        if not self._caching:
+            return self.r.hmget(self.name, fields)
+        return self.cache.fetch_many(self, fields, lambda missed: RedisConnectionManager.r(self).hmget(self.name, missed))
+
+    def get_many(self, keys, default=None):
+        """Values of keys in order, default for missing ones, in one HMGET."""
+        fields = [self.pickle_key(key) for key in keys]
+        unpickle_values = lambda values: [default if value is None else self.unpickle(value) for value in values]
+        if not fields:
+            return self._resolved([], unpickle_values)
+        return self._deferred(self._hmget(fields), unpickle_values)
+
+    def get_many_dict(self, keys, default=None):
+        keys = list(keys)
+        fields = [self.pickle_key(key) for key in keys]
+        unpickle_values = lambda values: dict((key, default if value is None else self.unpickle(value)) for key, value in izip(keys, values))
+        if not fields:
+            return self._resolved([], unpickle_values)
+        return self._deferred(self._hmget(fields), unpickle_values)
+
+    def _hexists_many(self, keys, callback):
+        fields = [self.pickle_key(key) for key in keys]
+        if not fields:
+            return self._resolved([], callback)
+        if self._caching:
+            return callback([value is not None for value in self._hmget(fields)])
+        return self._deferred(self._script(HEXISTS_MANY_SCRIPT)(keys=[self.name], args=fields, client=self.r), callback)
+
+    def contains_many(self, keys):
+        """Whether each of keys is in the dict, in order, in one command."""
+        return self._hexists_many(keys, lambda exists: [bool(flag) for flag in exists])
+
+    def contains_many_dict(self, keys):
+        keys = list(keys)
+        return self._hexists_many(keys, lambda exists: dict((key, bool(flag)) for key, flag in izip(keys, exists)))
+
+    def set_many(self, items):
+        """Sets the pairs of items, a dict or (key, value) pairs, in one
+        round trip, dropping only those fields from the cache.
+        """
+        items = items.iteritems() if hasattr(items, 'iteritems') else items
+        mapping = dict((self.pickle_key(key), self.pickle(value)) for key, value in items)
+        if not mapping:
+            return
+        def hset_chunks(pipe):
+            for chunk in chunked(mapping.iteritems(), self.chunk_size):
+                if self.nested:
+                    self._drop_nested(pipe, dict(chunk))
+                pipe.hset(self.name, mapping=dict(chunk))
+        self._write(hset_chunks, mapping.keys(), transaction=self.nested)
+
+    def delete_many(self, keys):
+        """Deletes keys with one HDEL, returning how many of them existed."""
+        fields = [self.pickle_key(key) for key in keys]
+        if not fields:
+            return self._resolved(0, int)
+        if self.nested:
+            return self._write(lambda client: self._drop_nested(client, fields, True), fields)
+        return self._write(lambda client: client.hdel(self.name, *fields), fields)
+
+    def pop_many(self, keys):
+        """Deletes keys in one MULTI, returning a dict of the ones that
+        existed with their values.
+        """
+        keys = list(keys)
+        fields = [self.pickle_key(key) for key in keys]
+        if not fields:
+            return self._resolved({}, dict)
+        if self.nested:
+            # Children are read before the delete drops them.
+            missing = object()
+            popped = dict((key, self._materialize(value)) for key, value in self.get_many_dict(keys, missing).iteritems() if value is not missing)
+            self.delete_many(keys)
+            return popped
+        def hmget_hdel(pipe):
+            pipe.hmget(self.name, fields)
+            pipe.hdel(self.name, *fields)
+        unpickle_values = lambda values: dict((key, self.unpickle(value)) for key, value in izip(keys, values) if value is not None)
+        return self._write(hmget_hdel, fields, unpickle_values, transaction=True)
+
+    def _hset_items(self, pipe, name, obj, kwargs):
+        items = obj.iteritems() if hasattr(obj, 'iteritems') else obj
+        pickled_items = ((self.pickle_key(key), self.pickle(value)) for key, value in chain(items, kwargs.iteritems()))
+        chunks = 0
+        for chunk in chunked(pickled_items, self.chunk_size):
+            if self.nested and name == self.name:
+                self._drop_nested(pipe, dict(chunk))
+            pipe.hset(name, mapping=dict(chunk))
+            chunks += 1
+        return chunks
+
+    def update(self, obj=(), **kwargs):
+        self._write(lambda pipe: self._hset_items(pipe, self.name, obj, kwargs), transaction=self.nested)
+
+    def scan(self, count=None, match=None):
+        """Streams pickled (key, value) pairs with HSCAN, count fields per
+        cursor step. match is a Redis glob applied to the encoded keys.
+        Fields added or removed while scanning may or may not be seen.
+        """
+        return self._streaming.hscan_iter(self.name, match, count or self.scan_count)
+
+    def iterkeys(self, count=None, match=None):
+        return (self.unpickle_key(key) for key, value in self.scan(count, match))
 
     def keys(self):
-        return list(self.__iter__())
+        return self._deferred(self.r.hkeys(self.name), lambda keys: [self.unpickle_key(key) for key in keys])
 
     def sorted_keys(self):
-        return sorted(self.__iter__())
+        return sorted(self.keys())
 
-    def itervalues(self):
-        return (self.unpickle(value) for value in self.r.hvals(self.name))
+    def itervalues(self, count=None, match=None):
+        return (self.unpickle(value) for key, value in self.scan(count, match))
 
     def values(self):
-        return list(self.itervalues())
+        return self._deferred(self.r.hvals(self.name), lambda values: [self.unpickle(value) for value in values])
 
-    def iteritems(self):
-        return ((self.unpickle(key), self.unpickle(value)) for key, value in self.r.hgetall(self.name).iteritems())
+    def iteritems(self, count=None, match=None):
+        return ((self.unpickle_key(key), self.unpickle(value)) for key, value in self.scan(count, match))
 
     def items(self):
-        return list(self.iteritems())
+        return self._deferred(self.r.hgetall(self.name), lambda items: [(self.unpickle_key(key), self.unpickle(value)) for key, value in items.iteritems()])
 
-    def __getitem__(self, key):
-        pickled_value = self.r.hget(self.name, self.pickle(key))
+    def _unpickle_value(self, key, pickled_value):
         if pickled_value is None:
             raise KeyError('Key "{}" is not valid'.format(key))
         return self.unpickle(pickled_value)
 
+    def __getitem__(self, key):
+        return self._deferred(self._hget(self.pickle_key(key)), lambda pickled_value: self._unpickle_value(key, pickled_value))
+
     def __setitem__(self, key, value):
-        self.r.hset(self.name, self.pickle(key), self.pickle(value))
+        field = self.pickle_key(key)
+        if self.nested:
+            pickled_value = self.pickle(value)
+            def replace(pipe):
+                self._drop_nested(pipe, [field])
+                pipe.hset(self.name, field, pickled_value)
+            self._write(replace, [field], transaction=True)
+            return
+        self._write(lambda client: client.hset(self.name, field, self.pickle(value)), [field])
 
     def __delitem__(self, key):
-        self.r.hdel(self.name, self.pickle(key))
+        field = self.pickle_key(key)
+        if self.nested:
+            self._write(lambda client: self._drop_nested(client, [field], True), [field])
+            return
+        self._write(lambda client: client.hdel(self.name, field), [field])
 
     def __contains__(self, key):
-        return self.r.hexists(self.name, self.pickle(key))
+        if self._caching:
+            return self._hget(self.pickle_key(key)) is not None
+        return self._deferred(self.r.hexists(self.name, self.pickle_key(key)), bool)
 
     def __iter__(self):
-        return (self.unpickle(key) for key in self.r.hkeys(self.name))
+        return self.iterkeys()
 
     def __reversed__(self):
         return (key for key in self.keys()[::-1])
@@ -165,74 +1915,438 @@ class RedisDict(RedisObject):
     def __eq__(self, other):
         if type(other) not in (dict, RedisDict):
             return False
-        self_keys = self.keys()
-        other_keys = other.keys()
-        if set(self_keys) != set(other_keys):
-            return False
-        for k in self_keys:
-            if self[k] != other[k]:
-                return False
-        return True
+        if type(other) is RedisDict:
+            if (other.connection_key, other.name) == (self.connection_key, self.name):
+                return True
+            other = other.__dict__()
+        return self.__dict__() == other
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __len__(self):
-        return self.r.hlen(self.name)
+        return self._deferred(self.r.hlen(self.name), int)
+
+@instrumented
+class ShardedRedisDict(object):
+    """Dict spread over a fixed number of bucket hashes named name:0 ..
+    name:N-1, placed on nodes by consistent hashing. Nodes are (host, port)
+    or (host, port, db) tuples. Operations touching many buckets send one
+    pipeline per node, all nodes in parallel.
+
+    reshard moves the buckets whose owner changes to their new node a chunk
+    at a time while this object keeps serving reads and writes; processes
+    with their own ShardedRedisDict should be recreated with the new nodes
+    once it finishes. Batches and caches are not supported.
+    """
+    # Points per node on the hash ring.
+    replicas = 100
+    chunk_size = 1000
+
+    def __init__(self, name, nodes=(('localhost', 6379),), buckets=64, key_codec=None, value_codec=None, **connection_kwargs):
+        self.name = name
+        self.bucket_count = buckets
+        self.key_codec = key_codec
+        self.value_codec = value_codec
+        self.connection_kwargs = connection_kwargs
+        self.nodes = [self._normalize(node) for node in nodes]
+        ring = self._ring(self.nodes)
+        self.buckets = [self._bucket(index, self._owner(ring, index)) for index in xrange(buckets)]
+        # Bucket index -> the bucket on its previous node while it is moved.
+        self.migrating = {}
+
+    @staticmethod
+    def _normalize(node):
+        return tuple(node) if len(node) > 2 else tuple(node) + (0,)
+
+    @staticmethod
+    def _node(bucket):
+        return (bucket.host, bucket.port, bucket.db)
+
+    def _ring(self, nodes):
+        return sorted((zlib.crc32(':'.join(str(part) for part in node + (point,))) & 0xffffffff, node) for node in nodes for point in xrange(self.replicas))
+
+    def _owner(self, ring, index):
+        point = zlib.crc32('{}:{}'.format(self.name, index)) & 0xffffffff
+        return ring[bisect_left(ring, (point,)) % len(ring)][1]
+
+    def _bucket(self, index, node):
+        host, port, db = node
+        return RedisDict('{}:{}'.format(self.name, index), host, port, db, self.key_codec, self.value_codec, **self.connection_kwargs)
+
+    def pickle_key(self, key):
+        return self.buckets[0].pickle_key(key)
+
+    def unpickle_key(self, key):
+        return self.buckets[0].unpickle_key(key)
+
+    def pickle(self, value):
+        return self.buckets[0].pickle(value)
+
+    def unpickle(self, value):
+        return self.buckets[0].unpickle(value)
+
+    def _index(self, field):
+        return (zlib.crc32(field) & 0xffffffff) % self.bucket_count
+
+    def _fan_out(self, command, buckets=None, transaction=False):
+        """Queues command(pipe, bucket) for every bucket, on one pipeline per
+        node, and sends the pipelines from one thread per node. Returns the
+        list of replies each bucket's commands got, in bucket order.
+        """
+        buckets = self.buckets if buckets is None else buckets
+        nodes = OrderedDict()
+        for position, bucket in enumerate(buckets):
+            nodes.setdefault(bucket.connection_key, []).append((position, bucket))
+        replies = [None] * len(buckets)
+        errors = []
+        record = RedisInstrumentation.current()
+        def send(members):
+            RedisInstrumentation.local.record = record
+            try:
+                pipe = RedisConnectionManager.r(members[0][1]).pipeline(transaction)
+                counts = []
+                for position, bucket in members:
+                    queued = len(pipe.command_stack)
+                    command(pipe, bucket)
+                    counts.append(len(pipe.command_stack) - queued)
+                responses = iter(pipe.execute())
+                for (position, bucket), count in izip(members, counts):
+                    replies[position] = list(islice(responses, count))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=send, args=(members,)) for members in nodes.values()[1:]]
+        for thread in threads:
+            thread.start()
+        if nodes:
+            send(nodes.values()[0])
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return replies
+
+    def _all_buckets(self):
+        # Previous owners first, so fields already moved win when merged.
+        return self.migrating.values() + self.buckets
+
+    def _hget(self, field):
+        index = self._index(field)
+        bucket = self.buckets[index]
+        value = bucket.r.hget(bucket.name, field)
+        if value is None and index in self.migrating:
+            old = self.migrating[index]
+            value = old.r.hget(old.name, field)
+        return value
+
+    def get(self, key, default=None):
+        value = self._hget(self.pickle_key(key))
+        if value is None:
+            return default
+        return self.unpickle(value)
+
+    def __getitem__(self, key):
+        value = self._hget(self.pickle_key(key))
+        if value is None:
+            raise KeyError('Key "{}" is not valid'.format(key))
+        return self.unpickle(value)
+
+    def __setitem__(self, key, value):
+        field = self.pickle_key(key)
+        index = self._index(field)
+        bucket = self.buckets[index]
+        bucket.r.hset(bucket.name, field, self.pickle(value))
+        if index in self.migrating:
+            old = self.migrating[index]
+            old.r.hdel(old.name, field)
+
+    def __delitem__(self, key):
+        field = self.pickle_key(key)
+        index = self._index(field)
+        bucket = self.buckets[index]
+        if index not in self.migrating:
+            bucket.r.hdel(bucket.name, field)
+            return
+        # Holding the lock reshard moves chunks under, so a value it has
+        # read but not yet copied cannot come back after the delete.
+        old = self.migrating[index]
+        with old.acquire_lock():
+            bucket.r.hdel(bucket.name, field)
+            old.r.hdel(old.name, field)
+
+    def __contains__(self, key):
+        return self._hget(self.pickle_key(key)) is not None
+
+    def pop(self, key, default=None):
+        value = self.get(key)
+        self.__delitem__(key)
+        return value or default
+
+    def setdefault(self, key, default=None):
+        value = self.get(key)
+        if value is not None:
+            return value
+        self.__setitem__(key, default)
+        return default
+
+    def _group(self, obj, kwargs):
+        items = obj.iteritems() if hasattr(obj, 'iteritems') else obj
+        groups = defaultdict(dict)
+        for key, value in chain(items, kwargs.iteritems()):
+            field = self.pickle_key(key)
+            groups[self._index(field)][field] = self.pickle(value)
+        return groups
+
+    def _hset_group(self, pipe, bucket, groups):
+        # A bucket has the same name on its old and new node.
+        for chunk in chunked(groups.get(bucket.name, {}).iteritems(), self.chunk_size):
+            pipe.hset(bucket.name, mapping=dict(chunk))
+
+    def update(self, obj=(), **kwargs):
+        groups = self._group(obj, kwargs)
+        by_name = dict((self.buckets[index].name, fields) for index, fields in groups.iteritems())
+        self._fan_out(lambda pipe, bucket: self._hset_group(pipe, bucket, by_name), [self.buckets[index] for index in sorted(groups)])
+        moved = [self.migrating[index] for index in groups if index in self.migrating]
+        if moved:
+            self._fan_out(lambda pipe, old: pipe.hdel(old.name, *by_name[old.name]), moved)
+
+    def clear(self):
+        self._fan_out(lambda pipe, bucket: pipe.delete(bucket.name), self._all_buckets())
+
+    def set_to(self, py_dict):
+        # The buckets on each node are replaced in one MULTI; different
+        # nodes are not replaced atomically with each other.
+        groups = self._group(py_dict, {})
+        by_name = dict((self.buckets[index].name, fields) for index, fields in groups.iteritems())
+        def replace(pipe, bucket):
+            pipe.delete(bucket.name)
+            self._hset_group(pipe, bucket, by_name)
+        self._fan_out(lambda pipe, bucket: pipe.delete(bucket.name), self.migrating.values())
+        self._fan_out(replace, transaction=True)
+
+    def _hgetall(self):
+        merged = {}
+        for replies in self._fan_out(lambda pipe, bucket: pipe.hgetall(bucket.name), self._all_buckets()):
+            merged.update(replies[0])
+        return merged
+
+    def keys(self):
+        if self.migrating:
+            return [self.unpickle_key(key) for key in self._hgetall()]
+        return [self.unpickle_key(key) for replies in self._fan_out(lambda pipe, bucket: pipe.hkeys(bucket.name)) for key in replies[0]]
+
+    def values(self):
+        return [value for key, value in self.items()]
+
+    def items(self):
+        return [(self.unpickle_key(key), self.unpickle(value)) for key, value in self._hgetall().iteritems()]
+
+    def scan(self, count=None, match=None):
+        """Streams pickled (key, value) pairs with HSCAN, one bucket after
+        another. Fields moved by a concurrent reshard may be seen twice.
+        """
+        for bucket in self._all_buckets():
+            for item in bucket.scan(count, match):
+                yield item
+
+    def iterkeys(self, count=None, match=None):
+        return (self.unpickle_key(key) for key, value in self.scan(count, match))
+
+    def itervalues(self, count=None, match=None):
+        return (self.unpickle(value) for key, value in self.scan(count, match))
+
+    def iteritems(self, count=None, match=None):
+        return ((self.unpickle_key(key), self.unpickle(value)) for key, value in self.scan(count, match))
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __len__(self):
+        if self.migrating:
+            return len(self._hgetall())
+        return sum(replies[0] for replies in self._fan_out(lambda pipe, bucket: pipe.hlen(bucket.name)))
+
+    def __str__(self):
+        return str(self.__dict__())
+
+    def __repr__(self):
+        return repr(self.__dict__())
+
+    def __dict__(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if not isinstance(other, (dict, RedisDict, ShardedRedisDict)):
+            return False
+        return self.__dict__() == dict(other.items())
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
+    def reshard(self, nodes, chunk_size=None):
+        """Moves every bucket whose owner changes with nodes to its new node,
+        chunk_size fields at a time, yielding (bucket index, fields moved)
+        after each chunk so callers can pace the move. Fields are copied with
+        HSETNX, so writes made meanwhile to the new node are never overwritten,
+        and only deleted from the old node while they still hold the value
+        copied. A field that a process still on the old nodes changes in
+        between is copied again on a later pass, and one it deletes is
+        deleted from the new node as well.
+        A reshard that is stopped part way leaves its current bucket
+        readable from both nodes; running reshard again finishes it.
+        """
+        nodes = [self._normalize(node) for node in nodes]
+        ring = self._ring(nodes)
+        chunk_size = chunk_size or self.chunk_size
+        for index in xrange(self.bucket_count):
+            node = self._owner(ring, index)
+            while index in self.migrating or self._node(self.buckets[index]) != node:
+                if index not in self.migrating:
+                    self.migrating[index] = self.buckets[index]
+                    self.buckets[index] = self._bucket(index, node)
+                for moved in self._move(self.migrating[index], self.buckets[index], chunk_size):
+                    yield index, moved
+                del self.migrating[index]
+        self.nodes = nodes
+
+    def _move(self, old, bucket, chunk_size):
+        # Field -> the value copied for it when a process still writing to
+        # the old node changed the field before it could be deleted there.
+        copied = {}
+        cursor = 0
+        while True:
+            with old.acquire_lock():
+                cursor, items = old.r.hscan(old.name, cursor, count=chunk_size)
+                if items:
+                    pipe = bucket.r.pipeline(False)
+                    changes = []
+                    for field, value in items.iteritems():
+                        if field in copied:
+                            changes.extend((field, copied.pop(field), value))
+                        else:
+                            pipe.hsetnx(bucket.name, field, value)
+                    if changes:
+                        bucket._script(HSET_IF_EQUAL_SCRIPT)(keys=[bucket.name], args=changes, client=pipe)
+                    pipe.execute()
+                    pairs = [part for item in items.iteritems() for part in item]
+                    changed, removed = old._script(HDEL_IF_EQUAL_SCRIPT)(keys=[old.name], args=pairs, client=old.r)
+                    # Changed fields stay behind for a later pass; removed
+                    # ones are deleted from the copy unless it was replaced.
+                    for field in changed:
+                        copied[field] = items[field]
+                    if removed:
+                        bucket._script(HDEL_IF_EQUAL_SCRIPT)(keys=[bucket.name], args=[part for field in removed for part in (field, items[field])], client=bucket.r)
+            if items:
+                yield len(items)
+            if cursor == 0 and not old.r.exists(old.name):
+                return
+
+@instrumented
 class RedisList(RedisObject):
+    chunk_size = 1000
+    # Slices with a step at least this large are filtered on the server.
+    lua_step_threshold = 8
+
+    def iterate(self, chunk_size=None, snapshot=False):
+        """Streams the values in LRANGE pages of chunk_size, unpickling each
+        one only as it is reached.
+
+        Paging is live: values inserted or removed ahead of the current page
+        while iterating may be skipped or seen twice. With snapshot=True the
+        whole list is read atomically by a single LRANGE instead. Cached
+        lists iterate over the cached copy.
+        """
+        if self._caching:
+            for value in self._cached_values():
+                yield self.unpickle(value)
+            return
+        if snapshot:
+            for value in self._streaming.lrange(self.name, 0, -1):
+                yield self.unpickle(value)
+            return
+        chunk_size = chunk_size or self.chunk_size
+        start = 0
+        while True:
+            values = self._streaming.lrange(self.name, start, start + chunk_size - 1)
+            for value in values:
+                yield self.unpickle(value)
+            if len(values) < chunk_size:
+                return
+            start += chunk_size
+
+    def _cached_values(self):
+        # Lists are cached whole, since any write can shift every index.
+        return self.cache.fetch(self, None, lambda: RedisConnectionManager.r(self).lrange(self.name, 0, -1))
+
     def append(self, value):
-        self.r.rpush(self.name, self.pickle(value))
+        self._write(lambda client: client.rpush(self.name, self.pickle(value)))
 
     def extend(self, values):
-        self.r.rpush(self.name, *(self.pickle(value) for value in values))
+        pickled_values = [self.pickle(value) for value in values]
+        if pickled_values:
+            self._write(lambda client: client.rpush(self.name, *pickled_values))
 
     def insert(self, index, value):
-        self.r.linsert(self.name, index, self.pickle(value))
+        pickled_value = self.pickle(value)
+        self._write(lambda client: self._script(LINSERT_INDEX_SCRIPT)(keys=[self.name], args=[index, pickled_value, tombstone()], client=client))
 
     def remove(self, value):
-        self.r.lrem(self.name, self.pickle(value))
+        self._write(lambda client: client.lrem(self.name, 1, self.pickle(value)))
 
-    def pop(self, index=-1):
-        length = len(self)
-        if index < 0:
-            if index + length < 0:
-                raise IndexError('RedisList index out of range')
-            return self.unpickle(self.r.lrem(self.name, length + index))
-        if index > length - 1:
+    def _pop_index(self, client, index):
+        if index == -1:
+            return client.rpop(self.name)
+        if index == 0:
+            return client.lpop(self.name)
+        return self._script(LPOP_INDEX_SCRIPT)(keys=[self.name], args=[index, tombstone()], client=client)
+
+    def _popped(self, value):
+        if value is None:
             raise IndexError('RedisList index out of range')
-        return self.unpickle(self.r.lrem(self.name, index))
+        return value
 
-    def index(self, value):
-        index = self.r.index(self.name, self.pickle(value))
+    def pop(self, index=-1):
+        return self._write(lambda client: self._pop_index(client, index), callback=lambda value: self.unpickle(self._popped(value)))
+
+    def _indexed(self, value, index):
         if index is None:
             raise ValueError('{} is not in RedisList'.format(repr(value)))
         return index
 
+    def index(self, value):
+        """Position of the first value with the same encoding, found on the
+        server with LPOS.
+        """
+        return self._deferred(self.r.execute_command('LPOS', self.name, self.pickle(value)), lambda index: self._indexed(value, index))
+
     def count(self, value):
         count = 0
-        for v in self.__list__():
+        for v in self.iterate():
             if v == value:
                 count += 1
         return count
 
     def sort(self, *args, **kwargs):
         temp = sorted(self.__list__(), *args, **kwargs)
-        self.r.delete(self.name)
-        self.r.rpush(self.name, *(self.pickle(value) for value in temp))
+        self._replace(temp)
         return temp
 
     def reverse(self):
-        temp = self.__list__()[::-1]
-        self.r.delete(self.name)
-        self.r.rpush(self.name, *(self.pickle(value) for value in temp))
+        self._write(lambda client: self._script(LREVERSE_SCRIPT)(keys=[self.name], client=client))
 
     def clear(self):
-        self.r.delete(self.name)
+        self._write(lambda client: client.delete(self.name))
+
+    def _replace(self, values):
+        # DEL and RPUSH run in one MULTI so readers never see an empty list.
+        def replace(pipe):
+            pipe.delete(self.name)
+            for chunk in chunked((self.pickle(value) for value in values), self.chunk_size):
+                pipe.rpush(self.name, *chunk)
+        self._write(replace, transaction=True)
 
     def set_to(self, new_list):
-        self.clear()
-        self.r.rpush(self.name, *(self.pickle(value) for value in new_list))
+        self._replace(new_list)
 
     def __add__(self, value):
         if type(value) is list:
@@ -242,21 +2356,21 @@ class RedisList(RedisObject):
         raise TypeError('can only concatenate list or RedisList (not "{}") to RedisList'.format(type(value)))
 
     def __delitem__(self, index):
-        temp = self.__list__()
-        del(temp[index])
-        self.r.delete(self.name)
-        self.r.rpush(self.name, *(self.pickle(value) for value in temp))
-
-    def __delslice__(self, *coords):
-        i, j = coords
-        n = 1 if len(coords) != 3 else coords[2]
-        temp = self.__list__()
-        del(temp[i:j:n])
-        self.r.delete(self.name)
-        self.r.rpush(self.name, *(self.pickle(value) for value in temp))
+        # There is deliberately no __delslice__, so Python 2 passes plain
+        # slices here unadjusted instead of calling len() first.
+        if type(index) is slice:
+            bounds = ['' if bound is None else bound for bound in (index.start, index.stop)]
+            step = 1 if index.step is None else index.step
+            if step == 0:
+                raise ValueError('slice step cannot be zero')
+            self._write(lambda client: self._script(LDEL_SLICE_SCRIPT)(keys=[self.name], args=bounds + [step, tombstone()], client=client))
+            return
+        self._write(lambda client: self._pop_index(client, index), callback=self._popped)
 
     def __list__(self):
-        return [self.unpickle(value) for value in self.r.lrange(self.name, 0, -1)]
+        if self._caching:
+            return [self.unpickle(value) for value in self._cached_values()]
+        return self._deferred(self.r.lrange(self.name, 0, -1), lambda values: [self.unpickle(value) for value in values])
 
     def __str__(self):
         return str(self.__list__())
@@ -264,35 +2378,594 @@ class RedisList(RedisObject):
     def __repr__(self):
         return repr(self.__list__())
 
+    def _length(self):
+        # len() that runs right away inside a batch too, for __eq__.
+        if self._caching:
+            return len(self._cached_values())
+        return self._streaming.llen(self.name)
+
     def __eq__(self, other):
         if type(other) in (list, RedisList):
-            if len(self) != len(other):
+            if self._length() != (other._length() if isinstance(other, RedisList) else len(other)):
                 return False
-            return all(a == b for a, b in izip(self.__list__(), other))
+            return all(a == b for a, b in izip(self.iterate(), other))
         return False
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __contains__(self, value):
-        return any(self_value == value for self_value in self.__iter__())
+        return any(self_value == value for self_value in self.iterate())
 
     def __iter__(self):
-        return (self.unpickle(self.r.lindex(self.name, i)) for i in xrange(self.__len__()))
+        return self.iterate()
 
     def __len__(self):
-        return self.r.llen(self.name)
+        if self._caching:
+            return len(self._cached_values())
+        return self._deferred(self.r.llen(self.name), int)
+
+    def _slice(self, coords):
+        step = 1 if coords.step is None else coords.step
+        if step == 0:
+            raise ValueError('slice step cannot be zero')
+        if self._caching:
+            return [self.unpickle(value) for value in self._cached_values()[coords]]
+        # LRANGE resolves negative bounds against the length just like
+        # Python does, so only the inclusive window needs translating.
+        if step > 0:
+            if coords.stop == 0:
+                return []
+            lower = 0 if coords.start is None else coords.start
+            upper = -1 if coords.stop is None else coords.stop - 1
+        else:
+            if coords.stop == -1:
+                return []
+            lower = 0 if coords.stop is None else coords.stop + 1
+            upper = -1 if coords.start is None else coords.start
+        if abs(step) >= self.lua_step_threshold:
+            response = self._script(LRANGE_STEP_SCRIPT)(keys=[self.name], args=[lower, upper, step], client=self.r)
+            return self._deferred(response, lambda values: [self.unpickle(value) for value in values])
+        return self._deferred(self.r.lrange(self.name, lower, upper), lambda values: [self.unpickle(value) for value in values[::step]])
 
     def __getitem__(self, coords):
         if type(coords) is slice:
-            return [self.unpickle(value) for value in self.r.lrange(self.name, 0, -1)[coords]]
+            return self._slice(coords)
         if type(coords) is int:
-            return self.unpickle(self.r.lindex(self.name, coords))
+            if self._caching:
+                try:
+                    return self.unpickle(self._cached_values()[coords])
+                except IndexError:
+                    raise IndexError('RedisList index out of range')
+            return self._deferred(self.r.lindex(self.name, coords), lambda value: self.unpickle(self._popped(value)))
+
+@instrumented
+class RedisQueue(RedisList):
+    """RedisList used as a FIFO work queue (LIFO with lifo=True): put appends,
+    get pops from the head and can block on the server until a value comes.
+
+    For reliable delivery consumers reserve values instead, which moves each
+    one into the consumer's own processing list and starts a lease of
+    visibility_timeout seconds. ack removes a finished value; requeue_expired
+    puts the values of consumers whose lease ran out back at the head of the
+    queue. Leases compare client clocks. The connection's socket_timeout, if
+    any, must be longer than the blocking timeouts used.
+
+    Pops and moves bump the version and refresh the expiry like any other
+    write; after a blocking pop these follow on a plain pipeline rather than
+    in one MULTI, and a pop that timed out still bumps the version.
+    """
+    visibility_timeout = 30
+
+    def __init__(self, name, *args, **kwargs):
+        self.visibility_timeout = kwargs.pop('visibility_timeout', self.visibility_timeout)
+        self.lifo = kwargs.pop('lifo', False)
+        super(RedisQueue, self).__init__(name, *args, **kwargs)
+
+    @property
+    def leases_name(self):
+        return '{}:leases'.format(self.name)
 
+    def processing_name(self, consumer):
+        return '{}:processing:{}'.format(self.name, consumer)
+
+    @property
+    def _end(self):
+        return 'RIGHT' if self.lifo else 'LEFT'
+
+    def put(self, *values):
+        self.extend(values)
+
+    def get(self, block=True, timeout=None, default=None):
+        """Pops the next value, waiting up to timeout seconds (forever when
+        None) for one when block is set; default when none came.
+        """
+        def pop(client):
+            if block:
+                return (client.brpop if self.lifo else client.blpop)([self.name], timeout or 0)
+            return (client.rpop if self.lifo else client.lpop)(self.name)
+        def unpickle_value(reply):
+            value = reply[1] if block and reply else reply
+            return default if value is None else self.unpickle(value)
+        return self._write(pop, callback=unpickle_value, blocking=block)
+
+    def get_many(self, count):
+        """Pops up to count values without blocking, with one LPOP count."""
+        return self._write(lambda client: client.execute_command('RPOP' if self.lifo else 'LPOP', self.name, count),
+                           callback=lambda values: [self.unpickle(value) for value in values or ()])
+
+    def extend_lease(self, consumer, pipe=None):
+        client = pipe or RedisConnectionManager.r(self)
+        return client.zadd(self.leases_name, {consumer: time.time() + self.visibility_timeout})
+
+    def reserve(self, consumer, block=True, timeout=None, default=None):
+        """Moves the next value into consumer's processing list, waiting like
+        get, and returns it. The lease is renewed once the move returns, in
+        the same round trip.
+        """
+        def move(pipe):
+            if block:
+                pipe.execute_command('BLMOVE', self.name, self.processing_name(consumer), self._end, 'RIGHT', timeout or 0)
+            else:
+                pipe.execute_command('LMOVE', self.name, self.processing_name(consumer), self._end, 'RIGHT')
+            self.extend_lease(consumer, pipe)
+        return self._write(move, callback=lambda value: default if value is None else self.unpickle(value), transaction=False, blocking=block)
+
+    def processing(self, consumer):
+        return [self.unpickle(value) for value in RedisConnectionManager.r(self).lrange(self.processing_name(consumer), 0, -1)]
+
+    def ack(self, consumer, value):
+        """Drops a value consumer finished; False if it was not reserved."""
+        return bool(RedisConnectionManager.r(self).lrem(self.processing_name(consumer), 1, self.pickle(value)))
+
+    def requeue(self, consumer, value):
+        """Puts a value consumer gave up on back at the head of the queue."""
+        requeue = self._script(REQUEUE_SCRIPT)
+        return self._write(lambda client: requeue(keys=[self.name, self.processing_name(consumer)], args=[self.pickle(value), self._end], client=client), callback=bool)
+
+    def requeue_expired(self, now=None):
+        """Puts every value held by a consumer whose lease ended before now
+        back at the head of the queue, returning how many were moved.
+        """
+        requeue_expired = self._script(REQUEUE_EXPIRED_SCRIPT)
+        return self._write(lambda client: requeue_expired(keys=[self.name, self.leases_name], args=[now or time.time(), self.processing_name(''), self._end], client=client))
+
+@instrumented
 class RedisSet(RedisObject):
-    pass
+    """Set of encoded members. Algebra between RedisSets on the same
+    connection runs on the server and expects them to share a value codec;
+    plain Python sets are combined client-side.
+    """
+    scan_count = 1000
+    # Members sent per multi-member SADD by update.
+    chunk_size = 1000
+
+    def add(self, value):
+        self._write(lambda client: client.sadd(self.name, self.pickle(value)))
+
+    def update(self, *iterables):
+        pickled_values = (self.pickle(value) for value in chain(*iterables))
+        def add_chunks(pipe):
+            for chunk in chunked(pickled_values, self.chunk_size):
+                pipe.sadd(self.name, *chunk)
+        self._write(add_chunks, transaction=False)
+
+    def discard(self, value):
+        self._write(lambda client: client.srem(self.name, self.pickle(value)))
+
+    def _removed(self, value, removed):
+        if not removed:
+            raise KeyError(value)
+
+    def remove(self, value):
+        self._write(lambda client: client.srem(self.name, self.pickle(value)), callback=lambda removed: self._removed(value, removed))
+
+    def _popped(self, value):
+        if value is None:
+            raise KeyError('pop from an empty RedisSet')
+        return self.unpickle(value)
+
+    def pop(self):
+        return self._write(lambda client: client.spop(self.name), callback=self._popped)
+
+    def clear(self):
+        self._write(lambda client: client.delete(self.name))
+
+    def scan(self, count=None, match=None):
+        """Streams encoded members with SSCAN; see RedisDict.scan."""
+        return self._streaming.sscan_iter(self.name, match, count or self.scan_count)
+
+    def members(self):
+        return self._deferred(self.r.smembers(self.name), lambda values: set(self.unpickle(value) for value in values))
+
+    def _server_side(self, others):
+        return all(isinstance(other, RedisSet) and other.connection_key == self.connection_key for other in others)
+
+    def _names(self, others):
+        return [self.name] + [other.name for other in others]
+
+    def _setop(self, command, others):
+        return self._deferred(getattr(self.r, command)(self._names(others)), lambda values: set(self.unpickle(value) for value in values))
+
+    def _setop_empty(self, command, others):
+        return self._deferred(self._script(SETOP_CARD_SCRIPT)(keys=self._names(others), args=[command], client=self.r), lambda card: card == 0)
+
+    def _dest(self, dest):
+        if isinstance(dest, RedisSet):
+            return dest
+        return RedisSet(dest, host=self.host, port=self.port, db=self.db, value_codec=self.value_codec, **self.connection_kwargs)
+
+    def _store(self, command, dest, others, combine):
+        # Runs on the server when every set, dest included, shares this
+        # connection; otherwise combine(*others) is computed here and written
+        # over dest in one MULTI.
+        dest = self._dest(dest)
+        if self._server_side(list(others) + [dest]):
+            dest._write(lambda client: getattr(client, command)(dest.name, self._names(others)))
+        else:
+            dest._replace(combine(*others))
+        return dest
+
+    def _replace(self, values):
+        pickled_values = [self.pickle(value) for value in values]
+        def replace(pipe):
+            pipe.delete(self.name)
+            for chunk in chunked(pickled_values, self.chunk_size):
+                pipe.sadd(self.name, *chunk)
+        self._write(replace, transaction=True)
+
+    def intersection(self, *others):
+        if self._server_side(others):
+            return self._setop('sinter', others)
+        return set(self.scan_members()).intersection(*others)
+
+    def union(self, *others):
+        if self._server_side(others):
+            return self._setop('sunion', others)
+        return set(self.scan_members()).union(*others)
+
+    def difference(self, *others):
+        if self._server_side(others):
+            return self._setop('sdiff', others)
+        return set(self.scan_members()).difference(*others)
+
+    def symmetric_difference(self, other):
+        if self._server_side([other]):
+            return self.difference(other) | other.difference(self)
+        return set(self.scan_members()).symmetric_difference(other)
+
+    def intersection_store(self, dest, *others):
+        """Writes the intersection into the RedisSet (or key name) dest and
+        returns it as a RedisSet. others may be plain Python sets, at the
+        cost of reading this set.
+        """
+        return self._store('sinterstore', dest, others, self.intersection)
+
+    def union_store(self, dest, *others):
+        return self._store('sunionstore', dest, others, self.union)
+
+    def difference_store(self, dest, *others):
+        return self._store('sdiffstore', dest, others, self.difference)
+
+    def symmetric_difference_store(self, dest, other):
+        dest = self._dest(dest)
+        if not self._server_side([other, dest]):
+            dest._replace(self.symmetric_difference(other))
+            return dest
+        temp_name = '{}:xor:{}'.format(dest.name, uuid4().hex)
+        def store(pipe):
+            pipe.sinterstore(temp_name, [self.name, other.name])
+            pipe.sunionstore(dest.name, [self.name, other.name])
+            pipe.sdiffstore(dest.name, [dest.name, temp_name])
+            pipe.delete(temp_name)
+        dest._write(store, transaction=True)
+        return dest
+
+    def issubset(self, other):
+        if self._server_side([other]):
+            return self._setop_empty('SDIFF', [other])
+        return set(self.scan_members()).issubset(other)
+
+    def issuperset(self, other):
+        if self._server_side([other]):
+            return other.issubset(self)
+        return set(self.scan_members()).issuperset(other)
+
+    def isdisjoint(self, other):
+        if self._server_side([other]):
+            return self._setop_empty('SINTER', [other])
+        return set(self.scan_members()).isdisjoint(other)
+
+    def scan_members(self, count=None, match=None):
+        return (self.unpickle(value) for value in self.scan(count, match))
+
+    __and__ = intersection
+    __or__ = union
+    __sub__ = difference
+    __xor__ = symmetric_difference
+    __le__ = issubset
+    __ge__ = issuperset
+
+    def __contains__(self, value):
+        return self._deferred(self.r.sismember(self.name, self.pickle(value)), bool)
+
+    def __iter__(self):
+        return self.scan_members()
 
+    def __len__(self):
+        return self._deferred(self.r.scard(self.name), int)
+
+    def __str__(self):
+        return str(self.members())
+
+    def __repr__(self):
+        return repr(self.members())
+
+    def __eq__(self, other):
+        if isinstance(other, RedisSet) and self._server_side([other]):
+            return len(self) == len(other) and self.issubset(other)
+        if isinstance(other, (set, frozenset, RedisSet)):
+            return self.members() == set(other)
+        return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+@instrumented
 class RedisSortedSet(RedisObject):
+    """Mapping of encoded members to float scores, kept ordered by score on
+    the server. Lexicographic ranges compare encoded members, so they are
+    only meaningful with a value codec such as RawCodec.
+    """
+    scan_count = 1000
+    # Members sent per multi-member ZADD by update.
+    chunk_size = 1000
+    # Members fetched per LIMIT page while streaming ranges.
+    page_size = 1000
+
+    def clear(self):
+        self._write(lambda client: client.delete(self.name))
+
+    def update(self, obj=(), **kwargs):
+        items = obj.iteritems() if hasattr(obj, 'iteritems') else obj
+        pickled_items = ((self.pickle(member), score) for member, score in chain(items, kwargs.iteritems()))
+        def add_chunks(pipe):
+            for chunk in chunked(pickled_items, self.chunk_size):
+                pipe.zadd(self.name, dict(chunk))
+        self._write(add_chunks, transaction=False)
+
+    def increment(self, member, amount=1):
+        """Adds amount to the score of member (starting from 0) and returns
+        the new score.
+        """
+        return self._write(lambda client: client.zincrby(self.name, amount, self.pickle(member)))
+
+    def get(self, member, default=None):
+        return self._deferred(self.r.zscore(self.name, self.pickle(member)), lambda score: default if score is None else score)
+
+    def _found(self, member, value):
+        if value is None:
+            raise KeyError('Member "{}" is not valid'.format(member))
+        return value
+
+    def rank(self, member, reverse=False):
+        command = self.r.zrevrank if reverse else self.r.zrank
+        return self._deferred(command(self.name, self.pickle(member)), lambda rank: self._found(member, rank))
+
+    def count(self, min='-inf', max='+inf'):
+        return self._deferred(self.r.zcount(self.name, min, max), int)
+
+    def _unpickle_items(self, items, withscores):
+        if withscores:
+            return [(self.unpickle(member), score) for member, score in items]
+        return [self.unpickle(member) for member in items]
+
+    def range_by_rank(self, start=0, stop=-1, reverse=False, withscores=False):
+        """Members ranked start to stop inclusive, as with ZRANGE."""
+        return self._deferred(self.r.zrange(self.name, start, stop, reverse, withscores), lambda items: self._unpickle_items(items, withscores))
+
+    def _paged(self, fetch, withscores, page_size):
+        page_size = page_size or self.page_size
+        offset = 0
+        while True:
+            items = fetch(offset, page_size)
+            for item in self._unpickle_items(items, withscores):
+                yield item
+            if len(items) < page_size:
+                return
+            offset += page_size
+
+    def range_by_score(self, min='-inf', max='+inf', reverse=False, withscores=False, page_size=None):
+        """Streams members scored min to max (ZRANGEBYSCORE syntax, so '(5'
+        excludes 5) in LIMIT pages of page_size, highest first if reverse.
+        """
+        if reverse:
+            fetch = lambda offset, count: self._streaming.zrevrangebyscore(self.name, max, min, offset, count, withscores)
+        else:
+            fetch = lambda offset, count: self._streaming.zrangebyscore(self.name, min, max, offset, count, withscores)
+        return self._paged(fetch, withscores, page_size)
+
+    def range_by_lex(self, min='-', max='+', reverse=False, page_size=None):
+        """Streams members between min and max (ZRANGEBYLEX syntax) in LIMIT
+        pages; all members should share one score.
+        """
+        if reverse:
+            fetch = lambda offset, count: self._streaming.zrevrangebylex(self.name, max, min, offset, count)
+        else:
+            fetch = lambda offset, count: self._streaming.zrangebylex(self.name, min, max, offset, count)
+        return self._paged(fetch, False, page_size)
+
+    def _popped(self, items, count):
+        items = [(self.unpickle(member), score) for member, score in items]
+        if count is not None:
+            return items
+        if not items:
+            raise KeyError('pop from an empty RedisSortedSet')
+        return items[0]
+
+    def pop_min(self, count=None):
+        """Removes and returns the lowest scored (member, score), or a list of
+        up to count of them.
+        """
+        return self._write(lambda client: client.zpopmin(self.name, count), callback=lambda items: self._popped(items, count))
+
+    def pop_max(self, count=None):
+        return self._write(lambda client: client.zpopmax(self.name, count), callback=lambda items: self._popped(items, count))
+
+    def trim(self, size, keep_highest=True):
+        """Drops all but the size highest (or lowest) scored members with
+        ZREMRANGEBYRANK, e.g. to bound a top-K leaderboard.
+        """
+        if keep_highest:
+            self._write(lambda client: client.zremrangebyrank(self.name, 0, -size - 1))
+        else:
+            self._write(lambda client: client.zremrangebyrank(self.name, size, -1))
+
+    def scan(self, count=None, match=None):
+        """Streams encoded (member, score) pairs with ZSCAN in no particular
+        order; see RedisDict.scan.
+        """
+        return self._streaming.zscan_iter(self.name, match, count or self.scan_count)
+
+    def iterkeys(self, page_size=None):
+        return self.range_by_score(page_size=page_size)
+
+    def keys(self):
+        return self.range_by_rank()
+
+    def iteritems(self, page_size=None):
+        return self.range_by_score(withscores=True, page_size=page_size)
+
+    def items(self):
+        return self.range_by_rank(withscores=True)
+
+    def __getitem__(self, member):
+        return self._deferred(self.r.zscore(self.name, self.pickle(member)), lambda score: self._found(member, score))
+
+    def __setitem__(self, member, score):
+        self._write(lambda client: client.zadd(self.name, {self.pickle(member): score}))
+
+    def __delitem__(self, member):
+        self._write(lambda client: client.zrem(self.name, self.pickle(member)))
+
+    def __contains__(self, member):
+        return self._deferred(self.r.zscore(self.name, self.pickle(member)), lambda score: score is not None)
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __len__(self):
+        return self._deferred(self.r.zcard(self.name), int)
+
+    def __str__(self):
+        return str(self.items())
+
+    def __repr__(self):
+        return repr(self.items())
+
+class RedisIndexConflict(Exception):
     pass
 
+@instrumented
+class RedisCollection(object):
+    """Family of RedisDict records named prefix + id. The ids of all records
+    are kept in a RedisSet, and each field listed in indexes has a unique
+    index hash from value to id. save and delete update the record, the id
+    set and the indexes atomically in one Lua call; writes made through the
+    RedisDict of a record directly bypass the indexes. Blank values (None or
+    '') are stored but not indexed, so any number of records may leave an
+    indexed field empty.
+    """
+    def __init__(self, prefix, indexes=(), host='localhost', port=6379, db=0, key_codec=None, value_codec=None, **connection_kwargs):
+        self.name = prefix
+        self.prefix = prefix
+        self.indexes = list(indexes)
+        self.host = host
+        self.port = port
+        self.db = db
+        self.key_codec = key_codec
+        self.value_codec = value_codec
+        self.connection_kwargs = connection_kwargs
+        self.ids = RedisSet('{}IDS'.format(prefix), host, port, db, key_codec, value_codec, **connection_kwargs)
+
+    def index_name(self, field):
+        return '{}INDEX:{}'.format(self.prefix, field)
+
+    def record(self, id):
+        return RedisDict('{}{}'.format(self.prefix, id), self.host, self.port, self.db, self.key_codec, self.value_codec, **self.connection_kwargs)
+
+    def _keys(self, record):
+        return [record.name, self.ids.name] + [self.index_name(field) for field in self.indexes]
+
+    def save(self, id, fields):
+        """Sets fields (a dict) of record id, creating it if needed. Raises
+        RedisIndexConflict, writing nothing, when an indexed value already
+        belongs to another record.
+        """
+        record = self.record(id)
+        pairs = [item for key, value in fields.iteritems() for item in (record.pickle_key(key), record.pickle(value))]
+        blank = ['1' if fields.get(field) in (None, '') else '0' for field in self.indexes]
+        args = [self.ids.pickle(id), len(fields)] + pairs + [record.pickle_key(field) for field in self.indexes] + blank
+        reply = self.ids._script(COLLECTION_SAVE_SCRIPT)(keys=self._keys(record), args=args, client=RedisConnectionManager.r(self.ids))
+        if reply != 1:
+            raise RedisIndexConflict('{} "{}" is already taken'.format(record.unpickle_key(reply), fields[record.unpickle_key(reply)]))
+
+    def delete(self, id):
+        """Deletes record id and its index entries; False if it did not exist."""
+        record = self.record(id)
+        args = [self.ids.pickle(id)] + [record.pickle_key(field) for field in self.indexes]
+        return bool(self.ids._script(COLLECTION_DELETE_SCRIPT)(keys=self._keys(record), args=args, client=RedisConnectionManager.r(self.ids)))
+
+    def find(self, field, value):
+        """Id of the record whose indexed field is value, or None."""
+        id = RedisConnectionManager.r(self.ids).hget(self.index_name(field), self.ids.pickle(value))
+        return None if id is None else self.ids.unpickle(id)
+
+    def load(self, ids, fields=None):
+        """Reads records ids (only fields, when given) with one pipelined
+        HGETALL or HMGET each, returning an OrderedDict of id to dict for
+        the ones that exist.
+        """
+        ids = list(ids)
+        records = [self.record(id) for id in ids]
+        if fields is not None:
+            fields = list(fields)
+        pipe = RedisConnectionManager.r(self.ids).pipeline(False)
+        for record in records:
+            if fields is None:
+                pipe.hgetall(record.name)
+            else:
+                pipe.hmget(record.name, [record.pickle_key(field) for field in fields])
+        loaded = OrderedDict()
+        for id, record, reply in izip(ids, records, pipe.execute() if records else ()):
+            if fields is None:
+                if reply:
+                    loaded[id] = dict((record.unpickle_key(key), record.unpickle(value)) for key, value in reply.iteritems())
+            elif any(value is not None for value in reply):
+                loaded[id] = dict((field, record.unpickle(value)) for field, value in izip(fields, reply) if value is not None)
+        return loaded
+
+    def load_all(self, fields=None):
+        return self.load(self.ids.members(), fields)
+
+    def reindex(self):
+        """Rebuilds the id set and the indexes from the records under prefix,
+        for data written before the collection existed.
+        """
+        client = RedisConnectionManager.r(self.ids)
+        reserved = set([self.ids.name] + [self.index_name(field) for field in self.indexes])
+        for name in client.scan_iter(match='{}*'.format(self.prefix), count=self.ids.scan_count):
+            if name not in reserved and client.type(name) == 'hash':
+                id = name[len(self.prefix):]
+                self.save(id, self.load([id], self.indexes).get(id, {}))
+
+    def __contains__(self, id):
+        return id in self.ids
+
+    def __iter__(self):
+        return self.ids.scan_members()
+
+    def __len__(self):
+        return len(self.ids)
+
 atexit.register(RedisObject.cleanup)
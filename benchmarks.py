@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+from RedisObjects import RedisDict, RedisList, PickleCodec, RawCodec, JSONCodec, MsgpackCodec, CompressedCodec
+import argparse
+import json
+import pickle
+import redis
+import sys
+import timeit
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+# Totals across every CountingConnection, diffed around each operation.
+COUNTERS = {'commands': 0, 'round_trips': 0, 'bytes_sent': 0, 'bytes_received': 0}
+
+def reply_size(response):
+    """Approximate payload size of a parsed reply."""
+    if response is None:
+        return 0
+    if isinstance(response, (list, tuple)):
+        return sum(reply_size(item) for item in response)
+    if isinstance(response, (str, unicode, bytearray)):
+        return len(response)
+    return len(str(response))
+
+def counting_connection(base):
+    class CountingConnection(base):
+        def pack_command(self, *args):
+            COUNTERS['commands'] += 1
+            return super(CountingConnection, self).pack_command(*args)
+
+        def send_packed_command(self, command, *args, **kwargs):
+            COUNTERS['round_trips'] += 1
+            COUNTERS['bytes_sent'] += sum(len(chunk) for chunk in ([command] if isinstance(command, str) else command))
+            return super(CountingConnection, self).send_packed_command(command, *args, **kwargs)
+
+        def read_response(self):
+            try:
+                response = super(CountingConnection, self).read_response()
+            except redis.ResponseError as exception:
+                COUNTERS['bytes_received'] += len(str(exception))
+                raise
+            COUNTERS['bytes_received'] += reply_size(response)
+            return response
+    return CountingConnection
+
+# Every public method of RedisDict and RedisList, as (name, kind, operation).
+# operation(obj, data, i) runs call i against obj, populated from data.
+# 'point' operations run calls times and 'bulk' ones (O(n) in the size) fewer
+# times on larger sizes. 'destructive' ones remove one entry per call, so obj
+# shrinks as they run and they run at most size times. 'reset' ones empty obj,
+# which is repopulated before every call outside the timings and counters;
+# they run as often as 'bulk' ones.
+DICT_OPERATIONS = [
+    ('__getitem__', 'point', lambda rd, data, i: rd[i % len(data)]),
+    ('get', 'point', lambda rd, data, i: rd.get(i % len(data))),
+    ('__contains__', 'point', lambda rd, data, i: (i % len(data)) in rd),
+    ('__len__', 'point', lambda rd, data, i: len(rd)),
+    ('__setitem__', 'point', lambda rd, data, i: rd.__setitem__(i % len(data), i)),
+    ('setdefault', 'point', lambda rd, data, i: rd.setdefault(i % len(data), i)),
+    ('update', 'point', lambda rd, data, i: rd.update((j, i) for j in xrange(min(len(data), 100)))),
+    ('__delitem__', 'destructive', lambda rd, data, i: rd.__delitem__(i)),
+    ('pop', 'destructive', lambda rd, data, i: rd.pop(i)),
+    ('popitem', 'destructive', lambda rd, data, i: rd.popitem()),
+    ('clear', 'reset', lambda rd, data, i: rd.clear()),
+    ('set_to', 'bulk', lambda rd, data, i: rd.set_to(data)),
+    ('keys', 'bulk', lambda rd, data, i: rd.keys()),
+    ('sorted_keys', 'bulk', lambda rd, data, i: rd.sorted_keys()),
+    ('values', 'bulk', lambda rd, data, i: rd.values()),
+    ('items', 'bulk', lambda rd, data, i: rd.items()),
+    ('iterkeys', 'bulk', lambda rd, data, i: list(rd.iterkeys())),
+    ('itervalues', 'bulk', lambda rd, data, i: list(rd.itervalues())),
+    ('iteritems', 'bulk', lambda rd, data, i: list(rd.iteritems())),
+    ('__reversed__', 'bulk', lambda rd, data, i: list(reversed(rd))),
+    ('__eq__', 'bulk', lambda rd, data, i: rd == data),
+    ('__str__', 'bulk', lambda rd, data, i: str(rd)),
+]
+
+LIST_OPERATIONS = [
+    ('__getitem__', 'point', lambda rl, data, i: rl[i % len(data)]),
+    ('__getitem__[:10]', 'point', lambda rl, data, i: rl[:10]),
+    ('__getitem__[-10:]', 'point', lambda rl, data, i: rl[-10:]),
+    ('__len__', 'point', lambda rl, data, i: len(rl)),
+    ('append', 'point', lambda rl, data, i: rl.append(i)),
+    ('extend', 'point', lambda rl, data, i: rl.extend(xrange(10))),
+    ('insert', 'point', lambda rl, data, i: rl.insert(len(data) // 2, i)),
+    ('pop', 'destructive', lambda rl, data, i: rl.pop()),
+    ('pop(0)', 'destructive', lambda rl, data, i: rl.pop(0)),
+    ('pop(middle)', 'destructive', lambda rl, data, i: rl.pop((len(data) - i) // 2)),
+    ('__delitem__', 'destructive', lambda rl, data, i: rl.__delitem__((len(data) - i) // 2)),
+    ('remove', 'destructive', lambda rl, data, i: rl.remove(i)),
+    ('clear', 'reset', lambda rl, data, i: rl.clear()),
+    ('__getitem__[::10]', 'bulk', lambda rl, data, i: rl[::10]),
+    ('__getitem__[::-1]', 'bulk', lambda rl, data, i: rl[::-1]),
+    ('__delitem__[::10]', 'bulk', lambda rl, data, i: rl.__delitem__(slice(None, None, 10))),
+    ('set_to', 'bulk', lambda rl, data, i: rl.set_to(data)),
+    ('__iter__', 'bulk', lambda rl, data, i: list(rl)),
+    ('__list__', 'bulk', lambda rl, data, i: rl.__list__()),
+    ('__contains__', 'bulk', lambda rl, data, i: -1 in rl),
+    ('count', 'bulk', lambda rl, data, i: rl.count(0)),
+    ('index', 'bulk', lambda rl, data, i: rl.index(data[-1])),
+    ('__eq__', 'bulk', lambda rl, data, i: rl == data),
+    ('__add__', 'bulk', lambda rl, data, i: rl + []),
+    ('__str__', 'bulk', lambda rl, data, i: str(rl)),
+    ('reverse', 'bulk', lambda rl, data, i: rl.reverse()),
+    ('sort', 'bulk', lambda rl, data, i: rl.sort()),
+]
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+def calls_for(kind, size, calls):
+    if kind == 'point':
+        return calls
+    if kind == 'destructive':
+        return max(1, min(calls, size))
+    return max(3, min(calls, 100000 // size))
+
+def operation_benchmark(sizes, calls=1000, connection_kwargs=None):
+    """Throughput, latency percentiles, commands, round trips and bytes per
+    call of every DICT_OPERATIONS and LIST_OPERATIONS entry at each size.
+    """
+    connection_kwargs = connection_kwargs or {'connection_class': counting_connection(redis.Connection)}
+    results = []
+    for size in sizes:
+        for cls, operations, data in ((RedisDict, DICT_OPERATIONS, dict((i, 'value{}'.format(i)) for i in xrange(size))), (RedisList, LIST_OPERATIONS, range(size))):
+            obj = cls('benchmark_{}'.format(cls.__name__), **connection_kwargs)
+            for name, kind, operation in operations:
+                obj.set_to(data)
+                count = calls_for(kind, size, calls)
+                before = dict(COUNTERS)
+                latencies = []
+                for i in xrange(count):
+                    if kind == 'reset' and i:
+                        repopulating = dict(COUNTERS)
+                        obj.set_to(data)
+                        for counter in COUNTERS:
+                            before[counter] += COUNTERS[counter] - repopulating[counter]
+                    start = timeit.default_timer()
+                    operation(obj, data, i)
+                    latencies.append(timeit.default_timer() - start)
+                total = sum(latencies)
+                latencies.sort()
+                result = {
+                    'benchmark': 'operation',
+                    'object': cls.__name__,
+                    'operation': name,
+                    'size': size,
+                    'calls': count,
+                    'ops_per_sec': count / total if total else float('inf'),
+                    'p50_seconds': percentile(latencies, 0.5),
+                    'p99_seconds': percentile(latencies, 0.99),
+                }
+                for counter in sorted(COUNTERS):
+                    result['{}_per_call'.format(counter)] = float(COUNTERS[counter] - before[counter]) / count
+                results.append(result)
+            obj.clear()
+    return results
+
+def compare(results, baseline_path, tolerance):
+    """Lines describing operations that issue more commands per call, or
+    are more than tolerance slower, than in the baseline JSON lines file.
+    """
+    key = lambda result: (result['object'], result['operation'], result['size'])
+    with open(baseline_path) as baseline_file:
+        baseline = dict((key(result), result) for result in (json.loads(line) for line in baseline_file) if result.get('benchmark') == 'operation')
+    regressions = []
+    for result in results:
+        old = baseline.get(key(result))
+        if old is None:
+            continue
+        if result['commands_per_call'] > old['commands_per_call']:
+            regressions.append('{} {}[{}]: {:.1f} commands per call, was {:.1f}'.format(result['object'], result['operation'], result['size'], result['commands_per_call'], old['commands_per_call']))
+        if result['ops_per_sec'] < old['ops_per_sec'] * (1 - tolerance):
+            regressions.append('{} {}[{}]: {:.0f} ops/sec, was {:.0f}'.format(result['object'], result['operation'], result['size'], result['ops_per_sec'], old['ops_per_sec']))
+    return regressions
+
+SAMPLES = {
+    'record': {'id': 1234, 'username': 'guest', 'email': 'guest@example.com', 'active': True},
+    'numbers': range(100),
+    'text': 'lorem ipsum dolor sit amet ' * 200,
+}
+
+def codecs():
+    codecs = [
+        ('pickle0', PickleCodec(0, pickle)),
+        ('cpickle0', PickleCodec(0)),
+        ('cpickle', PickleCodec()),
+        ('json', JSONCodec()),
+        ('zlib+cpickle', CompressedCodec(PickleCodec())),
+    ]
+    try:
+        codecs.append(('msgpack', MsgpackCodec()))
+    except ImportError:
+        pass
+    return codecs
+
+def per_call(func, number, repeat):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+def codec_benchmark(fields=1000, repeat=3):
+    """Encode/decode cost of every codec on each sample value, and the Redis
+    MEMORY USAGE of a hash holding fields copies of it.
+    """
+    results = []
+    for sample_name, sample in sorted(SAMPLES.items()):
+        for codec_name, codec in codecs():
+            encoded = codec.dumps(sample)
+            redis_dict = RedisDict('benchmark_codec_{}_{}'.format(sample_name, codec_name), key_codec=RawCodec(), value_codec=codec)
+            redis_dict.update(('field{}'.format(i), sample) for i in xrange(fields))
+            results.append({
+                'benchmark': 'codec',
+                'sample': sample_name,
+                'codec': codec_name,
+                'encoded_bytes': len(encoded),
+                'encode_seconds': per_call(lambda: codec.dumps(sample), fields, repeat),
+                'decode_seconds': per_call(lambda: codec.loads(encoded), fields, repeat),
+                'memory_usage': redis_dict.r.memory_usage(redis_dict.name, samples=0),
+            })
+            redis_dict.clear()
+    return results
+
+def key_codec_benchmark(fields=1000):
+    """Redis MEMORY USAGE of a hash with fields short string keys per key codec."""
+    results = []
+    for codec_name, codec in [('pickle0', PickleCodec(0, pickle)), ('cpickle', PickleCodec()), ('raw', RawCodec())]:
+        redis_dict = RedisDict('benchmark_key_codec_{}'.format(codec_name), key_codec=codec, value_codec=RawCodec())
+        redis_dict.update(('field{}'.format(i), '') for i in xrange(fields))
+        results.append({
+            'benchmark': 'key_codec',
+            'codec': codec_name,
+            'encoded_bytes': len(codec.dumps('field0')),
+            'memory_usage': redis_dict.r.memory_usage(redis_dict.name, samples=0),
+        })
+        redis_dict.clear()
+    return results
+
+CODEC_COLUMNS = ['benchmark', 'sample', 'codec', 'encoded_bytes', 'encode_seconds', 'decode_seconds', 'memory_usage']
+OPERATION_COLUMNS = ['object', 'operation', 'size', 'ops_per_sec', 'p50_seconds', 'p99_seconds', 'commands_per_call', 'round_trips_per_call', 'bytes_sent_per_call', 'bytes_received_per_call']
+
+def print_table(results, columns):
+    print(' '.join('{:>14}'.format(column[:14]) for column in columns))
+    for result in results:
+        print(' '.join('{:>14}'.format(result.get(column, '-') if type(result.get(column)) is not float else '{:.2e}'.format(result[column])) for column in columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark RedisObjects against a local redis-server')
+    parser.add_argument('suite', nargs='?', choices=['operations', 'codecs'], default='operations')
+    parser.add_argument('--sizes', default='10,100,1000,10000', help='comma separated element counts, e.g. 10,1000,1000000')
+    parser.add_argument('--calls', type=int, default=1000, help='calls per point operation')
+    parser.add_argument('--fields', type=int, default=1000, help='hash fields per codec sample')
+    parser.add_argument('--fake', action='store_true', help='run against an in-process fakeredis server')
+    parser.add_argument('--json', action='store_true', help='print results as JSON lines')
+    parser.add_argument('--baseline', help='JSON lines from an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed ops/sec drop against the baseline')
+    args = parser.parse_args()
+    if args.suite == 'codecs':
+        results = codec_benchmark(args.fields) + key_codec_benchmark(args.fields)
+        columns = CODEC_COLUMNS
+    else:
+        connection_kwargs = None
+        if args.fake:
+            if fakeredis is None or not hasattr(fakeredis, 'FakeConnection'):
+                parser.error('--fake needs fakeredis 1.0 or later')
+            connection_kwargs = {'connection_class': counting_connection(fakeredis.FakeConnection), 'server': fakeredis.FakeServer()}
+        results = operation_benchmark([int(size) for size in args.sizes.split(',')], args.calls, connection_kwargs)
+        columns = OPERATION_COLUMNS
+    if args.json:
+        for result in results:
+            print(json.dumps(result, sort_keys=True))
+    else:
+        print_table(results, columns)
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -1,10 +1,24 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
-from RedisObjects import RedisDict, RedisList, RedisLockInUse
+from RedisObjects import RedisDict, ShardedRedisDict, RedisList, RedisQueue, RedisSet, RedisSortedSet, RedisLockInUse, RedisConnectionManager, RedisFutureNotReady, pipeline
+from RedisObjects import PickleCodec, RawCodec, JSONCodec, CompressedCodec, RedisCache
+from RedisObjects import RedisInstrumentation, StatsSink, RedisTransactionFailed, transaction
+from RedisObjects import RedisCollection, RedisIndexConflict, RedisSnapshotError, dump, load
+from StringIO import StringIO
+try:
+    import flask
+    from RedisFlaskSession import RedisSessionInterface
+except ImportError:
+    flask = None
 from collections import defaultdict
 from contextlib import contextmanager
 from itertools import izip
+import time
+import gc
+import os
+import threading
+import redis
 from sets import ImmutableSet
 tests = defaultdict(list)
 
@@ -46,12 +60,701 @@ class RedisDictTests(object):
         except RedisLockInUse as exception:
             redis_dict.delete_lock()
 
+    @staticmethod
+    def lock_timeout_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            with redis_dict.acquire_lock(ttl=5) as lock:
+                start = time.time()
+                try:
+                    with redis_dict.acquire_lock(timeout=0.1):
+                        assert False
+                except RedisLockInUse:
+                    pass
+                assert 0.1 <= time.time() - start < 1
+                assert lock.extend(10)
+                assert 5000 < redis_dict.r.pttl(redis_dict.lock_name) <= 10000
+                other = redis_dict.lock()
+                other.token = 'not the holder'
+                assert not other.release()
+                assert redis_dict.r.exists(redis_dict.lock_name)
+            assert not redis_dict.r.exists(redis_dict.lock_name)
+            assert redis_dict.lock_stats['acquired'] == 1
+            assert redis_dict.lock_stats['timeouts'] == 1
+            with redis_dict.acquire_lock(ttl=0.05):
+                time.sleep(0.1)
+                with redis_dict.acquire_lock(raise_exception=True):
+                    pass
+
     @staticmethod
     def contains_test():
         with populated_dicts() as (py_dict, redis_dict):
             for key in py_dict:
                 assert key in redis_dict
 
+    @staticmethod
+    def update_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            redis_dict.chunk_size = 3
+            updates = dict((i, str(i)) for i in xrange(10))
+            py_dict.update(updates, extra=1)
+            redis_dict.update(updates, extra=1)
+            assert redis_dict == py_dict
+            py_dict.update([('pair', 2)])
+            redis_dict.update([('pair', 2)])
+            assert redis_dict == py_dict
+            redis_dict.set_to(updates)
+            assert redis_dict == updates
+            redis_dict.set_to({})
+            assert len(redis_dict) == 0
+
+    @staticmethod
+    def scan_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            assert set(redis_dict.iterkeys(count=2)) == set(py_dict.iterkeys())
+            assert dict(redis_dict.iteritems(count=2)) == py_dict
+            values = list(redis_dict.itervalues())
+            assert len(values) == len(py_dict)
+            assert all(value in values for value in py_dict.itervalues())
+            assert set(redis_dict.iterkeys(match='I*')) == set(key for key in py_dict if type(key) is int)
+
+    @staticmethod
+    def many_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            keys = [1, 'missing', (1, ), 2]
+            assert redis_dict.get_many(keys) == [py_dict[1], None, py_dict[(1, )], py_dict[2]]
+            assert redis_dict.get_many_dict(keys, 0) == {1: [1], 'missing': 0, (1, ): [(1, )], 2: {}}
+            assert redis_dict.contains_many(keys) == [True, False, True, True]
+            assert redis_dict.contains_many_dict(['missing', 2]) == {'missing': False, 2: True}
+            redis_dict.set_many({'a': 1, 'b': 2})
+            redis_dict.set_many([('c', 3)])
+            assert redis_dict.get_many(['a', 'b', 'c']) == [1, 2, 3]
+            assert redis_dict.delete_many(['a', 'missing']) == 1
+            assert redis_dict.pop_many(['b', 'c', 'missing']) == {'b': 2, 'c': 3}
+            assert redis_dict == py_dict
+            assert redis_dict.get_many([]) == [] and redis_dict.delete_many([]) == 0
+            with redis_dict.batch():
+                values = redis_dict.get_many([1, 2])
+                empty = redis_dict.contains_many([])
+                exists = redis_dict.contains_many([1, 'missing'])
+            assert values.result() == [[1], {}]
+            assert empty.result() == []
+            assert exists.result() == [True, False]
+
+    @staticmethod
+    def nested_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            nested_dict = RedisDict('redis_nested_dict_test_object', nested=True)
+            nested_dict.set_to(py_dict)
+            assert nested_dict == py_dict
+            child = nested_dict['2']
+            assert isinstance(child, RedisDict)
+            child[2]['deep'] = 1
+            py_dict['2'][2]['deep'] = 1
+            assert nested_dict == py_dict
+            assert nested_dict.r.hlen(child.name) == 1
+            assert nested_dict.pop('2') == py_dict.pop('2')
+            assert not nested_dict.r.exists(child.name)
+            nested_dict[1] = [1, 2]
+            nested_dict[1].append(3)
+            assert nested_dict[1] == [1, 2, 3]
+            nested_dict['copy'] = nested_dict[1]
+            nested_dict[1] = nested_dict[1]
+            nested_dict[1].append(4)
+            assert nested_dict[1] == [1, 2, 3, 4]
+            assert nested_dict['copy'] == [1, 2, 3]
+            other = RedisDict('redis_nested_dict_other_test_object', nested=True)
+            other.update(nested_dict)
+            assert other == nested_dict
+            assert other['copy'].name != nested_dict['copy'].name
+            other.clear()
+            nested_dict.clear()
+            raw_dict = RedisDict(nested_dict.name, nested=True, key_codec=RawCodec(), value_codec=RawCodec())
+            try:
+                raw_dict['spoof'] = 'RedisObjects:nested:redis_dict_test_object'
+                assert False
+            except ValueError:
+                pass
+            RedisDict(nested_dict.name, key_codec=RawCodec(), value_codec=RawCodec())['spoof'] = 'RedisObjects:nested:redis_dict_test_object'
+            assert raw_dict['spoof'] == 'RedisObjects:nested:redis_dict_test_object'
+            del(raw_dict['spoof'])
+            assert redis_dict.r.exists(redis_dict.name)
+            assert not nested_dict.r.keys('{}*'.format(nested_dict.name))
+
+    @staticmethod
+    def expiry_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            assert redis_dict.ttl() is None
+            assert redis_dict.expire(10)
+            assert 9 < redis_dict.ttl() <= 10
+            assert redis_dict.persist()
+            expiring = RedisDict(redis_dict.name, ttl=5)
+            expiring['touched'] = 1
+            assert 4 < expiring.ttl() <= 5
+            sliding = RedisDict(redis_dict.name, ttl=5, sliding=True)
+            sliding.expire(1)
+            sliding.sliding_resolution = 0
+            assert sliding['touched'] == 1
+            assert 4 < sliding.ttl() <= 5
+
+    @staticmethod
+    def lifecycle_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            handle = RedisDict(redis_dict.name)
+            assert handle in RedisDict.instances
+            del(handle)
+            gc.collect()
+            assert redis_dict == py_dict
+            assert len([obj for obj in RedisDict.instances if obj.name == redis_dict.name]) == 1
+            temporary = RedisDict('redis_temporary_test_object', delete_on_collect=True)
+            temporary['a'] = 1
+            del(temporary)
+            gc.collect()
+            assert not redis_dict.r.exists('redis_temporary_test_object')
+
+class FlakyConnection(redis.Connection):
+    """Drops the connection on the next fail_sends sends, before the command
+    goes out, or on the next fail_reads replies, after the server ran it.
+    """
+    fail_sends = 0
+    fail_reads = 0
+
+    def send_packed_command(self, command, check_health=True):
+        if FlakyConnection.fail_sends:
+            FlakyConnection.fail_sends -= 1
+            self.disconnect()
+            raise redis.ConnectionError('dropped before sending')
+        return super(FlakyConnection, self).send_packed_command(command, check_health)
+
+    def read_response(self):
+        response = super(FlakyConnection, self).read_response()
+        if FlakyConnection.fail_reads:
+            FlakyConnection.fail_reads -= 1
+            raise redis.ConnectionError('dropped after sending')
+        return response
+
+class RedisConnectionTests(object):
+    @staticmethod
+    def shared_client_test():
+        redis_dict = RedisDict('redis_connection_test_object')
+        redis_list = RedisList('redis_connection_test_object')
+        assert redis_dict.r is redis_list.r
+        other_db = RedisDict('redis_connection_test_object', db=1)
+        assert other_db.r is not redis_dict.r
+        pooled = RedisDict('redis_connection_test_object', max_connections=4, socket_timeout=5)
+        assert pooled.r is not redis_dict.r
+        assert pooled.r is RedisConnectionManager.r(pooled)
+        assert pooled.r.connection_pool.max_connections == 4
+
+    @staticmethod
+    def retry_test():
+        redis_list = RedisList('redis_connection_test_object', connection_class=FlakyConnection)
+        FlakyConnection.fail_sends = 2
+        redis_list.append(1)
+        assert redis_list.r.llen(redis_list.name) == 1
+        FlakyConnection.fail_reads = 1
+        try:
+            redis_list.append(2)
+            assert False
+        except redis.ConnectionError:
+            pass
+        FlakyConnection.fail_reads = 2
+        assert redis_list.r.lrange(redis_list.name, 0, -1) == [redis_list.pickle(1), redis_list.pickle(2)]
+        FlakyConnection.fail_reads = 1
+        try:
+            redis_list.pop()
+            assert False
+        except redis.ConnectionError:
+            pass
+        assert list(redis_list) == [1]
+        redis_list.clear()
+
+    @staticmethod
+    def thread_affinity_test():
+        # One connection for each of the three threads, pipelines included.
+        redis_dict = RedisDict('redis_connection_test_object', thread_affinity=True, max_connections=3)
+        versioned = RedisDict(redis_dict.name, versioned=True, thread_affinity=True, max_connections=3)
+        main = redis_dict.r
+        versioned['main'] = 1
+        results = []
+        def run():
+            results.append(redis_dict.r is redis_dict.r and redis_dict.r is not main)
+            redis_dict['thread'] = 1
+            versioned['versioned'] = 1
+            # Batches belong to the object, so each thread uses its own.
+            batched = RedisDict(redis_dict.name, versioned=True, thread_affinity=True, max_connections=3)
+            with batched.batch():
+                batched['batch'] = 1
+            batched.update({'update': 1})
+            for attempt in batched.transaction():
+                with attempt:
+                    batched['transaction'] = batched['thread']
+        threads = [threading.Thread(target=run) for i in xrange(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [True, True]
+        assert redis_dict.r is main
+        assert redis_dict['thread'] == redis_dict['batch'] == redis_dict['transaction'] == 1
+        redis_dict.clear()
+        redis_dict.r.delete(versioned.version_name)
+
+    @staticmethod
+    def fork_test():
+        redis_dict = RedisDict('redis_connection_test_object')
+        parent = redis_dict.r
+        redis_dict['pid'] = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            status = 0 if redis_dict.r is not parent and redis_dict['pid'] == os.getppid() else 1
+            os._exit(status)
+        assert os.waitpid(pid, 0)[1] == 0
+        assert redis_dict.r is parent
+        assert redis_dict['pid'] == os.getpid()
+        redis_dict.clear()
+
+class RedisCodecTests(object):
+    @staticmethod
+    def codec_test():
+        redis_dict = RedisDict('redis_codec_test_object', key_codec=RawCodec(), value_codec=CompressedCodec(JSONCodec(), threshold=64))
+        py_dict = {'short': [1, 2], 'long': 'x' * 1000, u'unicode': {'a': 1}}
+        redis_dict.set_to(py_dict)
+        assert redis_dict == py_dict
+        assert redis_dict.r.hget(redis_dict.name, 'short') == '\x00[1,2]'
+        assert len(redis_dict.r.hget(redis_dict.name, 'long')) < 100
+        assert set(redis_dict.iterkeys(match='s*')) == set(['short'])
+        redis_dict.clear()
+
+    @staticmethod
+    def pickle_protocol_test():
+        redis_list = RedisList('redis_codec_test_object', value_codec=PickleCodec())
+        redis_list.set_to([(1, 'a'), None])
+        assert redis_list == [(1, 'a'), None]
+        redis_list.remove(None)
+        assert redis_list == [(1, 'a')]
+        redis_list.clear()
+
+class RedisCacheTests(object):
+    @staticmethod
+    def version_cache_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            cache = RedisCache(check_interval=0)
+            cached_dict = RedisDict(redis_dict.name, cache=cache)
+            writer = RedisDict(redis_dict.name, cache=RedisCache())
+            assert cached_dict[1] == [1]
+            assert cached_dict[1] == [1]
+            assert 'missing' not in cached_dict
+            assert 'missing' not in cached_dict
+            assert cache.stats['hits'] == 2 and cache.stats['misses'] == 2
+            writer[1] = 'changed'
+            assert cached_dict[1] == 'changed'
+            cached_dict[1] = 'local'
+            assert cached_dict[1] == 'local'
+            redis_dict.r.delete(redis_dict.version_name)
+
+    @staticmethod
+    def bounded_cache_test():
+        with populated_lists() as (py_list, redis_list):
+            cache = RedisCache(max_entries=1, invalidation='tracking')
+            cached_list = RedisList(redis_list.name, cache=cache)
+            other_list = RedisList('redis_list_other_test_object', cache=cache)
+            other_list.set_to([1])
+            assert cached_list == py_list
+            assert cached_list[5] == py_list[5] and len(cached_list) == len(py_list)
+            assert other_list[0] == 1
+            assert cache.stats['evictions'] >= 1 and len(cache.entries) == 1
+            assert cached_list[-3:] == py_list[-3:]
+            redis_list.append(50)
+            time.sleep(0.1)
+            assert cached_list[-1] == 50
+            cached_list.pop()
+            assert cached_list == py_list
+            other_list.clear()
+            cache.close()
+
+    @staticmethod
+    def connection_cache_test():
+        for invalidation in ('version', 'tracking', 'keyspace'):
+            cache = RedisCache(invalidation=invalidation, check_interval=0)
+            cached = [RedisDict('redis_cache_db_test_object', db=db, cache=cache) for db in (0, 1)]
+            writers = [RedisDict('redis_cache_db_test_object', db=db, versioned=True) for db in (0, 1)]
+            writers[0].r.config_set('notify-keyspace-events', 'Kh')
+            for db, writer in enumerate(writers):
+                writer['key'] = db
+            assert [redis_dict['key'] for redis_dict in cached] == [0, 1]
+            writers[1]['key'] = 'changed'
+            time.sleep(0.1)
+            assert [redis_dict['key'] for redis_dict in cached] == [0, 'changed']
+            for writer in writers:
+                writer.clear()
+                writer.r.delete(writer.version_name)
+            writers[0].r.config_set('notify-keyspace-events', '')
+            cache.close()
+
+class RedisBatchTests(object):
+    @staticmethod
+    def batch_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            with redis_dict.batch():
+                redis_dict['batched'] = 'value'
+                del(redis_dict[1])
+                value = redis_dict['batched']
+                missing = redis_dict[1]
+                try:
+                    value.result()
+                    assert False
+                except RedisFutureNotReady:
+                    pass
+            assert value.result() == 'value'
+            try:
+                missing.result()
+                assert False
+            except KeyError:
+                pass
+            assert 1 not in redis_dict
+
+    @staticmethod
+    def pipeline_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            with populated_lists() as (py_list, redis_list):
+                with pipeline(redis_dict, redis_list, transaction=True):
+                    redis_dict['appended'] = 50
+                    redis_list.append(50)
+                    length = redis_list.__len__()
+                py_list.append(50)
+                assert length.result() == len(py_list)
+                assert redis_list == py_list
+                assert redis_dict['appended'] == 50
+
+    @staticmethod
+    def streaming_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            with populated_lists() as (py_list, redis_list):
+                with populated_sorted_sets() as (py_scores, redis_sorted_set):
+                    with pipeline(redis_dict, redis_list, redis_sorted_set):
+                        redis_list.append('queued')
+                        # Streamed reads run right away, before queued writes.
+                        assert 3 in redis_list and 'queued' not in redis_list
+                        assert redis_list == py_list and redis_list.count(3) == 1
+                        assert list(redis_list) == py_list
+                        assert set(redis_dict) == set(py_dict)
+                        assert dict(redis_dict.iteritems()) == py_dict
+                        assert list(redis_sorted_set.range_by_score(withscores=True)) == sorted(py_scores.items(), key=lambda item: (item[1], item[0]))
+                        assert list(redis_sorted_set.range_by_lex()) != []
+                    assert redis_list[-1] == 'queued'
+        with populated_sets() as ((py_a, py_b), (redis_a, redis_b)):
+            with pipeline(redis_a, redis_b):
+                assert set(redis_a) == py_a
+                subset = redis_a.issubset(redis_b)
+            assert subset.result() is False
+
+class RedisTransactionTests(object):
+    @staticmethod
+    def version_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            versioned = RedisDict(redis_dict.name, versioned=True)
+            version = versioned.version
+            assert not versioned.changed_since(version)
+            redis_dict['unversioned'] = 1
+            assert not versioned.changed_since(version)
+            versioned['versioned'] = 1
+            assert versioned.changed_since(version)
+            assert versioned.version == version + 1
+            redis_dict.r.delete(redis_dict.version_name)
+
+    @staticmethod
+    def transaction_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            with populated_lists() as (py_list, redis_list):
+                other = RedisDict(redis_dict.name)
+                attempts = 0
+                for attempt in transaction(redis_dict, redis_list):
+                    with attempt:
+                        attempts += 1
+                        value = redis_list[0]
+                        if attempts == 1:
+                            other['raced'] = True
+                        redis_dict['copied'] = value
+                        redis_list.append(value)
+                assert attempts == 2
+                assert redis_dict['copied'] == py_list[0]
+                assert redis_list[-1] == py_list[0]
+                try:
+                    for attempt in redis_dict.transaction(retries=3):
+                        with attempt:
+                            other['raced'] = redis_dict['raced']
+                            redis_dict['never'] = True
+                    assert False
+                except RedisTransactionFailed:
+                    pass
+                assert 'never' not in redis_dict
+
+class RedisSnapshotTests(object):
+    @staticmethod
+    def snapshot_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            with populated_lists() as (py_list, redis_list):
+                with populated_sorted_sets() as (py_scores, redis_sorted_set):
+                    for exact in (False, True):
+                        redis_dict.expire(60)
+                        snapshot = StringIO()
+                        assert dump(snapshot, redis_dict, redis_list, redis_sorted_set, RedisDict('missing'), exact=exact, chunk_size=3) == 3
+                        redis_dict['extra'] = 1
+                        redis_list.clear()
+                        redis_sorted_set.clear()
+                        snapshot.seek(0)
+                        assert load(snapshot, redis_dict, redis_list, redis_sorted_set) == [redis_dict, redis_list, redis_sorted_set]
+                        assert dict(redis_dict.items()) == py_dict
+                        assert 0 < redis_dict.ttl() <= 60
+                        assert list(redis_list) == py_list
+                        assert list(redis_sorted_set.range_by_score(withscores=True)) == sorted(py_scores.items(), key=lambda item: (item[1], item[0]))
+                        assert not redis_dict.r.keys('*:loading:*')
+                    copy = RedisList('redis_list_snapshot_copy')
+                    snapshot.seek(0)
+                    snapshot.truncate(len(snapshot.getvalue()) - 20)
+                    try:
+                        load(snapshot, redis_list)
+                        assert False
+                    except RedisSnapshotError:
+                        pass
+                    assert not redis_dict.r.keys('*:loading:*')
+                    path = '/tmp/redis_snapshot_test'
+                    assert redis_list.dump(path)
+                    copy.load(path)
+                    assert list(copy) == py_list
+                    os.remove(path)
+                    copy.clear()
+
+    @staticmethod
+    def nested_snapshot_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            nested_dict = RedisDict('redis_nested_snapshot_test_object', nested=True)
+            nested_dict.set_to(py_dict)
+            for exact in (False, True):
+                snapshot = StringIO()
+                # The hash, its four lists, its set and the dict under '2';
+                # the empty dicts have no key.
+                assert dump(snapshot, nested_dict, exact=exact) == 7
+                nested_dict.clear()
+                snapshot.seek(0)
+                assert len(load(snapshot, nested_dict)) == 7
+                assert nested_dict == py_dict
+            path = '/tmp/redis_nested_snapshot_test'
+            nested_dict.dump(path)
+            nested_dict.clear()
+            nested_dict.load(path)
+            assert nested_dict == py_dict
+            try:
+                RedisDict('redis_nested_snapshot_other_test_object', nested=True).load(path)
+                assert False
+            except RedisSnapshotError:
+                pass
+            os.remove(path)
+            nested_dict.clear()
+            assert not nested_dict.r.keys('{}*'.format(nested_dict.name))
+
+class RedisFlaskSessionTests(object):
+    @staticmethod
+    def session_test():
+        app = flask.Flask(__name__)
+        app.debug = True
+        interface = app.session_interface = RedisSessionInterface(prefix='redis_session_test_object:', ttl=60)
+        @app.route('/set')
+        def set_values():
+            flask.session.update({'a': 1, 'b': [1], 'c': 'x'})
+            return flask.session.sid
+        @app.route('/change')
+        def change():
+            del(flask.session['c'])
+            flask.session['e'] = 5
+            return ''
+        @app.route('/mutate')
+        def mutate():
+            flask.session['b'].append(2)
+            return ''
+        @app.route('/read')
+        def read():
+            return repr([flask.session.get(key) for key in 'abe'])
+        @app.route('/untouched')
+        def untouched():
+            return ''
+        client = app.test_client()
+        response = client.get('/set')
+        assert response.headers['X-Session-Commands'] == '2'
+        stored = RedisDict('redis_session_test_object:' + response.get_data())
+        assert dict(stored.items()) == {'a': 1, 'b': [1], 'c': 'x'}
+        assert 0 < stored.ttl() <= 60
+        # Written behind the session's back: only fields the request changes
+        # may be sent, so this survives.
+        stored['a'] = 'outside'
+        assert client.get('/change').headers['X-Session-Commands'] == '4'
+        assert dict(stored.items()) == {'a': 'outside', 'b': [1], 'e': 5}
+        assert client.get('/mutate').headers['X-Session-Commands'] == '3'
+        assert stored['b'] == [1, 2]
+        response = client.get('/read')
+        assert response.get_data() == repr(['outside', [1, 2], 5])
+        assert response.headers['X-Session-Commands'] == '2'
+        response = client.get('/untouched')
+        assert response.headers['X-Session-Commands'] == '0'
+        assert 'Set-Cookie' not in response.headers
+        assert interface.stats == {'requests': 5, 'commands': 11, 'round_trips': 7}
+        stored.clear()
+        # An id the client made up is never adopted.
+        chosen = 'f' * 32
+        client = app.test_client()
+        client.set_cookie('localhost', app.session_cookie_name, chosen)
+        response = client.get('/read')
+        assert 'Set-Cookie' in response.headers and chosen not in response.headers['Set-Cookie']
+        client.set_cookie('localhost', app.session_cookie_name, chosen)
+        sid = client.get('/set').get_data()
+        assert sid != chosen
+        assert not stored.r.exists('redis_session_test_object:' + chosen)
+        RedisDict('redis_session_test_object:' + sid).clear()
+
+@contextmanager
+def populated_collections():
+    records = dict(('user{}'.format(i), {'email': 'user{}@example.com'.format(i), 'age': i}) for i in xrange(20))
+    collection = RedisCollection('redis_collection_test_object:', indexes=['email'])
+    for id, fields in records.iteritems():
+        collection.save(id, fields)
+    yield (records, collection)
+    for id in list(collection):
+        collection.delete(id)
+
+class RedisCollectionTests(object):
+    @staticmethod
+    def basic_test():
+        with populated_collections() as (records, collection):
+            assert len(collection) == len(records)
+            assert 'user3' in collection and 'missing' not in collection
+            assert collection.load_all() == records
+            assert collection.load(['user2', 'missing', 'user1'], ['age']).items() == [('user2', {'age': 2}), ('user1', {'age': 1})]
+            assert collection.record('user4')['age'] == 4
+            collection.delete('user4')
+            assert 'user4' not in collection
+            assert not collection.record('user4').r.exists(collection.record('user4').name)
+
+    @staticmethod
+    def index_test():
+        with populated_collections() as (records, collection):
+            assert collection.find('email', 'user5@example.com') == 'user5'
+            collection.save('user5', {'email': 'new@example.com'})
+            assert collection.find('email', 'user5@example.com') is None
+            assert collection.find('email', 'new@example.com') == 'user5'
+            try:
+                collection.save('user6', {'email': 'new@example.com', 'age': 60})
+                assert False
+            except RedisIndexConflict:
+                pass
+            assert collection.record('user6')['age'] == 6
+            collection.delete('user5')
+            assert collection.find('email', 'new@example.com') is None
+            collection.ids.r.hdel(collection.index_name('email'), collection.ids.pickle('user7@example.com'))
+            collection.reindex()
+            assert collection.find('email', 'user7@example.com') == 'user7'
+            for id in ('user8', 'user9'):
+                collection.save(id, {'email': ''})
+            collection.save('user10', {'email': None})
+            assert collection.record('user9')['email'] == ''
+            assert collection.find('email', '') is None
+            assert collection.find('email', 'user8@example.com') is None
+            collection.save('user11', {'email': 'user8@example.com'})
+            collection.delete('user8')
+            assert collection.find('email', 'user8@example.com') == 'user11'
+
+@contextmanager
+def populated_sharded_dicts():
+    py_dict = dict((i, str(i)) for i in xrange(500))
+    sharded_dict = ShardedRedisDict('sharded_dict_test_object', [('localhost', 6379, 0)], buckets=8)
+    sharded_dict.set_to(py_dict)
+    yield (py_dict, sharded_dict)
+    sharded_dict.clear()
+    RedisDict.cleanup()
+
+class ShardedRedisDictTests(object):
+    @staticmethod
+    def basic_test():
+        with populated_sharded_dicts() as (py_dict, sharded_dict):
+            assert sharded_dict == py_dict
+            assert len(sharded_dict) == len(py_dict)
+            assert sharded_dict[7] == '7'
+            del(py_dict[7])
+            del(sharded_dict[7])
+            assert 7 not in sharded_dict
+            py_dict.update({'a': 1, 'b': 2})
+            sharded_dict.update({'a': 1, 'b': 2})
+            assert sorted(sharded_dict.iterkeys()) == sorted(py_dict)
+            assert len(set(bucket.name for bucket in sharded_dict.buckets)) == 8
+
+    @staticmethod
+    def reshard_test():
+        with populated_sharded_dicts() as (py_dict, sharded_dict):
+            nodes = [('localhost', 6379, 0), ('localhost', 6379, 1)]
+            written = False
+            for index, moved in sharded_dict.reshard(nodes, chunk_size=10):
+                if not written:
+                    written = True
+                    py_dict[5] = sharded_dict[5] = 'five'
+                    del(py_dict[6])
+                    del(sharded_dict[6])
+                    assert sharded_dict == py_dict
+            assert written
+            assert set(bucket.db for bucket in sharded_dict.buckets) == set([0, 1])
+            assert not sharded_dict.migrating
+            assert sharded_dict == py_dict
+
+    @staticmethod
+    def stale_writer_test():
+        with populated_sharded_dicts() as (py_dict, sharded_dict):
+            # Another process, still on the old node, changes one field and
+            # deletes another of each chunk between its HSCAN and HDEL.
+            client = sharded_dict.buckets[0].r
+            hscan = client.hscan
+            def stale_hscan(name, cursor=0, match=None, count=None):
+                cursor, items = hscan(name, cursor, match, count)
+                fields = sorted(items)
+                if len(fields) > 1:
+                    py_dict[sharded_dict.unpickle_key(fields[0])] = 'stale'
+                    client.hset(name, fields[0], sharded_dict.pickle('stale'))
+                    del py_dict[sharded_dict.unpickle_key(fields[1])]
+                    client.hdel(name, fields[1])
+                return cursor, items
+            client.hscan = stale_hscan
+            try:
+                for index, moved in sharded_dict.reshard([('localhost', 6379, 1)], chunk_size=10):
+                    pass
+            finally:
+                del client.hscan
+            assert 'stale' in sharded_dict.values()
+            assert sharded_dict == py_dict
+
+class RedisInstrumentationTests(object):
+    @staticmethod
+    def instrumentation_test():
+        with populated_dicts() as (py_dict, redis_dict):
+            records = []
+            stats = StatsSink()
+            RedisInstrumentation.enable(records.append, stats)
+            try:
+                redis_dict[1]
+                redis_dict.update({'a': 1, 'b': 2})
+                list(redis_dict.iterkeys())
+                with redis_dict.batch():
+                    redis_dict['c'] = 3
+                    redis_dict['d'] = 4
+            finally:
+                RedisInstrumentation.disable()
+            assert [record['method'] for record in records] == ['__getitem__', 'update', 'iterkeys', '__setitem__', '__setitem__', 'batch']
+            assert records[0]['commands'] == 1 and records[0]['round_trips'] == 1
+            assert records[0]['bytes_deserialized'] > 0
+            assert records[1]['bytes_serialized'] > 0
+            assert records[2]['round_trips'] >= 1
+            assert records[3]['commands'] == 0
+            assert records[5]['commands'] == 2 and records[5]['round_trips'] == 1
+            assert 'method="__getitem__",name="redis_dict_test_object"' in stats.prometheus()
+            redis_dict[1]
+            assert len(records) == 6
+
 @contextmanager
 def populated_lists():
     py_list = range(50)
@@ -82,6 +785,14 @@ class RedisListTests(object):
             assert py_list[-30:-2:-7] == redis_list[-30:-2:-7]
             assert py_list[-30:30:7] == redis_list[-30:30:7]
             assert py_list[::] == redis_list[::]
+            assert py_list[:0] == redis_list[:0]
+            assert py_list[5::-1] == redis_list[5::-1]
+            assert py_list[5:-1:-1] == redis_list[5:-1:-1]
+            assert py_list[-3:-100:-2] == redis_list[-3:-100:-2]
+            assert py_list[-100:100] == redis_list[-100:100]
+            assert py_list[::10] == redis_list[::10]
+            assert py_list[40:3:-9] == redis_list[40:3:-9]
+            assert py_list[::-1] == redis_list[::-1]
 
     @staticmethod
     def del_slice_test():
@@ -138,12 +849,55 @@ class RedisListTests(object):
             for value in py_list:
                 assert value in redis_list
 
+    @staticmethod
+    def chunked_iter_test():
+        with populated_lists() as (py_list, redis_list):
+            assert list(redis_list.iterate(chunk_size=7)) == py_list
+            assert list(redis_list.iterate(chunk_size=50)) == py_list
+            assert list(redis_list.iterate(snapshot=True)) == py_list
+            redis_list.append(1)
+            assert redis_list.count(1) == 2
+
     @staticmethod
     def equal_length_test():
         with populated_lists() as (py_list, redis_list):
             del(redis_list[-1])
             assert py_list != redis_list
 
+    @staticmethod
+    def pop_test():
+        with populated_lists() as (py_list, redis_list):
+            for index in (-1, 0, 5, -7):
+                assert py_list.pop(index) == redis_list.pop(index)
+                assert py_list == redis_list
+            try:
+                redis_list.pop(100)
+                assert False
+            except IndexError:
+                pass
+
+    @staticmethod
+    def index_error_test():
+        with populated_lists() as (py_list, redis_list):
+            cache = RedisCache(invalidation='tracking')
+            for lst in (redis_list, RedisList(redis_list.name, cache=cache)):
+                for index in (len(py_list), -len(py_list) - 1):
+                    try:
+                        lst[index]
+                        assert False
+                    except IndexError as e:
+                        assert str(e) == 'RedisList index out of range'
+            cache.close()
+
+    @staticmethod
+    def reverse_sort_test():
+        with populated_lists() as (py_list, redis_list):
+            py_list.reverse()
+            redis_list.reverse()
+            assert py_list == redis_list
+            assert sorted(py_list) == redis_list.sort()
+            assert sorted(py_list) == redis_list
+
     @staticmethod
     def remove_test():
         with populated_lists() as (py_list, redis_list):
@@ -154,16 +908,257 @@ class RedisListTests(object):
             assert value not in py_list
             assert value not in redis_list
 
+    @staticmethod
+    def insert_index_test():
+        with populated_lists() as (py_list, redis_list):
+            redis_list.append(py_list[10])
+            py_list.append(py_list[10])
+            for index, value in ((0, 'first'), (-1, 'before last'), (10, 'middle'), (1000, 'last'), (-1000, 'very first'), (11, 10)):
+                py_list.insert(index, value)
+                redis_list.insert(index, value)
+                assert redis_list == py_list
+            for value in (10, 'middle', 'last', 'very first'):
+                assert redis_list.index(value) == py_list.index(value)
+            try:
+                redis_list.index('missing')
+                assert False
+            except ValueError:
+                pass
+
+
+@contextmanager
+def populated_queues():
+    redis_queue = RedisQueue('redis_queue_test_object', visibility_timeout=0.1)
+    redis_queue.put(*range(10))
+    yield redis_queue
+    redis_queue.r.delete(redis_queue.name, redis_queue.leases_name, redis_queue.processing_name('consumer'))
+
+class RedisQueueTests(object):
+    @staticmethod
+    def queue_test():
+        with populated_queues() as redis_queue:
+            assert redis_queue.get() == 0
+            assert redis_queue.get(block=False) == 1
+            assert redis_queue.get_many(3) == [2, 3, 4]
+            assert redis_queue.get_many(10) == [5, 6, 7, 8, 9]
+            assert redis_queue.get_many(10) == []
+            start = time.time()
+            assert redis_queue.get(timeout=0.1, default='empty') == 'empty'
+            assert time.time() - start >= 0.1
+            redis_queue.put('a', 'b')
+            assert RedisQueue(redis_queue.name, lifo=True).get() == 'b'
+
+    @staticmethod
+    def reliable_test():
+        with populated_queues() as redis_queue:
+            assert redis_queue.reserve('consumer') == 0
+            assert redis_queue.reserve('consumer', block=False) == 1
+            assert redis_queue.reserve('consumer', timeout=0.1) == 2
+            assert redis_queue.processing('consumer') == [0, 1, 2]
+            assert redis_queue.ack('consumer', 1)
+            assert not redis_queue.ack('consumer', 1)
+            assert redis_queue.requeue('consumer', 2)
+            assert redis_queue[0] == 2
+            assert redis_queue.requeue_expired() == 0
+            time.sleep(0.1)
+            assert redis_queue.requeue_expired() == 1
+            assert redis_queue.processing('consumer') == []
+            assert redis_queue == [0, 2] + range(3, 10)
+
+    @staticmethod
+    def write_tracking_test():
+        with populated_queues() as redis_queue:
+            versioned = RedisQueue(redis_queue.name, versioned=True, ttl=60, visibility_timeout=0.1)
+            reader = RedisQueue(redis_queue.name, cache=RedisCache(check_interval=0))
+            assert len(reader) == 10
+            for pop in (versioned.get, lambda: versioned.get(block=False), lambda: versioned.get_many(2), lambda: versioned.reserve('consumer'), lambda: versioned.reserve('consumer', block=False)):
+                version = versioned.version
+                redis_queue.r.persist(redis_queue.name)
+                pop()
+                assert versioned.changed_since(version)
+                assert 0 < versioned.ttl() <= 60
+            assert len(reader) == 4
+            version = versioned.version
+            assert versioned.requeue('consumer', 4)
+            assert versioned.changed_since(version)
+            time.sleep(0.1)
+            version = versioned.version
+            assert versioned.requeue_expired() == 1
+            assert versioned.changed_since(version)
+            assert len(reader) == 6
+            redis_queue.r.delete(redis_queue.version_name)
+
+@contextmanager
+def populated_sets():
+    py_sets = (set(range(10)), set(range(5, 15)))
+    redis_sets = (RedisSet('redis_set_test_object_a'), RedisSet('redis_set_test_object_b'))
+    for py_set, redis_set in izip(py_sets, redis_sets):
+        redis_set.clear()
+        redis_set.update(py_set)
+    yield py_sets, redis_sets
+    for redis_set in redis_sets:
+        redis_set.clear()
+
+class RedisSetTests(object):
+    @staticmethod
+    def basic_test():
+        with populated_sets() as ((py_a, py_b), (redis_a, redis_b)):
+            assert redis_a == py_a and len(redis_a) == len(py_a)
+            assert set(redis_a) == py_a
+            assert 3 in redis_a and 30 not in redis_a
+            redis_a.add(30)
+            redis_a.discard(3)
+            assert 30 in redis_a and 3 not in redis_a
+            try:
+                redis_a.remove(3)
+                assert False
+            except KeyError:
+                pass
+            assert redis_a.pop() in py_a | set([30])
+
+    @staticmethod
+    def algebra_test():
+        with populated_sets() as ((py_a, py_b), (redis_a, redis_b)):
+            assert redis_a & redis_b == py_a & py_b
+            assert redis_a | redis_b == py_a | py_b
+            assert redis_a - redis_b == py_a - py_b
+            assert redis_a ^ redis_b == py_a ^ py_b
+            assert redis_a & py_b == py_a & py_b
+            assert not redis_a.issubset(redis_b) and not redis_a.isdisjoint(redis_b)
+            assert (redis_a & redis_b) <= py_a
+            stored = redis_a.intersection_store('redis_set_test_object_c', redis_b)
+            assert stored.issubset(redis_a) and redis_a.issuperset(stored)
+            assert stored == py_a & py_b
+            redis_a.symmetric_difference_store(stored, redis_b)
+            assert stored == py_a ^ py_b
+            redis_a.union_store(stored, {100}, redis_b)
+            assert stored == py_a | py_b | {100}
+            redis_a.difference_store(stored, {0, 1})
+            assert stored == py_a - {0, 1}
+            redis_a.intersection_store(stored, {0, 1, 100})
+            assert stored == {0, 1}
+            redis_a.symmetric_difference_store(stored, {0, 100})
+            assert stored == py_a ^ {0, 100}
+            stored.clear()
+
+
+@contextmanager
+def populated_sorted_sets():
+    py_dict = dict(('player{}'.format(i), float(i % 7)) for i in xrange(20))
+    redis_sorted_set = RedisSortedSet('redis_sorted_set_test_object')
+    redis_sorted_set.clear()
+    redis_sorted_set.update(py_dict)
+    yield (py_dict, redis_sorted_set)
+    redis_sorted_set.clear()
+
+class RedisSortedSetTests(object):
+    @staticmethod
+    def basic_test():
+        with populated_sorted_sets() as (py_dict, redis_sorted_set):
+            assert len(redis_sorted_set) == len(py_dict)
+            assert dict(redis_sorted_set.items()) == py_dict
+            assert redis_sorted_set['player3'] == 3.0
+            assert redis_sorted_set.increment('player3', 10) == 13.0
+            assert redis_sorted_set.rank('player3', reverse=True) == 0
+            redis_sorted_set['new'] = -1
+            assert redis_sorted_set.rank('new') == 0 and 'new' in redis_sorted_set
+            del(redis_sorted_set['new'])
+            assert 'new' not in redis_sorted_set
+            try:
+                redis_sorted_set['new']
+                assert False
+            except KeyError:
+                pass
+
+    @staticmethod
+    def range_test():
+        with populated_sorted_sets() as (py_dict, redis_sorted_set):
+            by_score = sorted(py_dict.items(), key=lambda item: (item[1], item[0]))
+            assert list(redis_sorted_set.range_by_score(withscores=True, page_size=3)) == by_score
+            assert list(redis_sorted_set.range_by_score(2, '(4', page_size=2)) == [member for member, score in by_score if 2 <= score < 4]
+            assert list(redis_sorted_set.iterkeys(page_size=4)) == redis_sorted_set.range_by_rank()
+            assert redis_sorted_set.range_by_rank(0, 2, reverse=True) == [member for member, score in by_score[::-1][:3]]
+            assert dict((redis_sorted_set.unpickle(member), score) for member, score in redis_sorted_set.scan(count=5)) == py_dict
+            assert redis_sorted_set.pop_min() == by_score[0]
+            assert redis_sorted_set.pop_max(2) == by_score[::-1][:2]
+            redis_sorted_set.trim(5)
+            assert redis_sorted_set.keys() == [member for member, score in by_score[-7:-2]]
+
+    @staticmethod
+    def lex_test():
+        redis_sorted_set = RedisSortedSet('redis_sorted_set_lex_test_object', value_codec=RawCodec())
+        redis_sorted_set.update((word, 0) for word in ('apple', 'banana', 'cherry', 'date'))
+        assert list(redis_sorted_set.range_by_lex('[b', '(d', page_size=1)) == ['banana', 'cherry']
+        assert list(redis_sorted_set.range_by_lex(reverse=True)) == ['date', 'cherry', 'banana', 'apple']
+        redis_sorted_set.clear()
+
 
 if __name__ == '__main__':
     RedisDictTests.basic_test()
     RedisDictTests.lock_test()
+    RedisDictTests.lock_timeout_test()
     RedisDictTests.contains_test()
+    RedisDictTests.update_test()
+    RedisDictTests.scan_test()
+    RedisDictTests.many_test()
+    RedisDictTests.nested_test()
+    RedisDictTests.expiry_test()
+    RedisDictTests.lifecycle_test()
+
+    RedisConnectionTests.shared_client_test()
+    RedisConnectionTests.retry_test()
+    RedisConnectionTests.thread_affinity_test()
+    RedisConnectionTests.fork_test()
+
+    RedisCodecTests.codec_test()
+    RedisCodecTests.pickle_protocol_test()
+
+    RedisCacheTests.version_cache_test()
+    RedisCacheTests.bounded_cache_test()
+    RedisCacheTests.connection_cache_test()
+
+    RedisBatchTests.batch_test()
+    RedisBatchTests.pipeline_test()
+    RedisBatchTests.streaming_test()
+
+    RedisTransactionTests.version_test()
+    RedisTransactionTests.transaction_test()
+
+    RedisSnapshotTests.snapshot_test()
+    RedisSnapshotTests.nested_snapshot_test()
+
+    if flask is not None:
+        RedisFlaskSessionTests.session_test()
+
+    RedisCollectionTests.basic_test()
+    RedisCollectionTests.index_test()
+
+    ShardedRedisDictTests.basic_test()
+    ShardedRedisDictTests.reshard_test()
+    ShardedRedisDictTests.stale_writer_test()
+
+    RedisInstrumentationTests.instrumentation_test()
 
     RedisListTests.basic_test()
     RedisListTests.slice_test()
     RedisListTests.del_slice_test()
     RedisListTests.iter_test()
     RedisListTests.contains_test()
+    RedisListTests.chunked_iter_test()
     RedisListTests.equal_length_test()
+    RedisListTests.pop_test()
+    RedisListTests.index_error_test()
+    RedisListTests.reverse_sort_test()
     RedisListTests.remove_test()
+    RedisListTests.insert_index_test()
+
+    RedisQueueTests.queue_test()
+    RedisQueueTests.reliable_test()
+    RedisQueueTests.write_tracking_test()
+
+    RedisSetTests.basic_test()
+    RedisSetTests.algebra_test()
+
+    RedisSortedSetTests.basic_test()
+    RedisSortedSetTests.range_test()
+    RedisSortedSetTests.lex_test()
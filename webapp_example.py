@@ -2,13 +2,19 @@
 
 import flask
 from hashlib import sha512
-from RedisObjects import RedisDict, RedisList
+from RedisObjects import RedisCollection, RedisIndexConflict
+from RedisFlaskSession import RedisSessionInterface
 import redis
 import pickle
 
 NAME = 'RedisObjects_example'
+# Idle sessions expire server-side after this many seconds.
+SESSION_TTL = 30 * 60
 app = flask.Flask(NAME)
 app.debug = True
+# One HGETALL when a request first uses the session and one pipelined write
+# back at the end; responses carry X-Session-Commands while debugging.
+app.session_interface = RedisSessionInterface(prefix='{}_session:'.format(NAME), ttl=SESSION_TTL)
 
 ####
 # Helper classes
@@ -17,86 +23,52 @@ app.debug = True
 class UserDoesNotExist(Exception):
     pass
 
-class RedisSession(object):
-    def __init__(self, sessionid):
-        self.sessionid = sessionid
-        self.redis_dict = RedisDict(self.session_key)
-
-    @property
-    def session_key(self):
-        return 'RedisSession_{}'.format(self.sessionid)
-
-    def __dict__(self):
-        return self.redis_dict.__dict__()
-
-    def set_dict(self, new_dict):
-        self.redis_dict.set_to(new_dict)
-
-    def get(self, key, default=None):
-        return self.__dict__().get(key, default)
-
-    def __getitem__(self, key):
-        self.redis_dict[key]
-
-    def __setitem__(self, key, value):
-        self.redis_dict[key] = value
-
-    def __delitem__(self, key):
-        del(self.redis_dict[key])
-
-    @classmethod
-    def get_session(cls):
-        sessionid = flask.request.cookies.get('sessionid')
-        if sessionid is None:
-            return flask.redirect('/login')
-        return cls(flask.request.cookies.get('sessionid'))
-
+class Session(object):
     @classmethod
     def get_user(cls, redirect=True):
-        session = cls.get_session()
-        username = session.get('username')
+        username = flask.session.get('username')
         if username is None:
             if redirect:
                 return flask.redirect('/login')
             return
         try:
-            user = User(username)
+            return User(username)
         except UserDoesNotExist:
-            del(session['username'])
+            del(flask.session['username'])
             if redirect:
                 return flask.redirect('/login')
             return
-        return User(username)
 
     @classmethod
     def set_user(cls, user):
-        session = cls.get_session()
         if user is None:
-            del(session['username'])
+            flask.session.pop('username', None)
             return
-        session['username'] = user.username
+        flask.session['username'] = user.username
 
 class User(object):
-    userlist = RedisList('{}_userlist'.format(NAME))
+    # Records keep the names the per-user RedisDicts had; users.reindex()
+    # picks up ones written before the collection was used.
+    users = RedisCollection('{}_user_'.format(NAME), indexes=['email'])
 
-    def __init__(self, username):
+    def __init__(self, username, fields=None):
         self.username = username
-        self.redis_dict = RedisDict(self.redis_dict_name(self.username))
-        try:
-            self.redis_dict['password']
-        except KeyError:
-            self.redis_dict.clear()
+        if fields is None:
+            fields = self.users.load([username]).get(username, {})
+        if 'password' not in fields:
             raise UserDoesNotExist('User "{}" does not exist'.format(username))
+        self.fields = fields
 
-    @staticmethod
-    def redis_dict_name(username):
-        return '{}_user_{}'.format(NAME, username)
+    @classmethod
+    def all(cls):
+        # Two round trips however many users there are.
+        return sorted((cls(username, fields) for username, fields in cls.users.load_all().iteritems() if 'password' in fields), key=lambda user: user.username)
 
     @classmethod
     def login(cls, username, password):
-        redis_dict = RedisDict(cls.redis_dict_name(username))
-        if redis_dict.get('password', '') == cls.hash_password(password):
-            return User(username)
+        user = cls.get_user(username)
+        if user is not None and user.password == cls.hash_password(password):
+            return user
 
     @classmethod
     def get_user(cls, username):
@@ -106,26 +78,27 @@ class User(object):
             return None
 
     @classmethod
-    def create_user(cls, username, password):
-        redis_dict = RedisDict(cls.redis_dict_name(username))
-        redis_dict['password'] = cls.hash_password(password)
-        if username not in cls.userlist:
-            cls.userlist.append(username)
+    def create_user(cls, username, password, email=''):
+        # One save, so a taken email leaves no half-created user behind.
+        cls.users.save(username, {'password': cls.hash_password(password), 'email': email})
         return cls(username)
 
     @classmethod
     def delete_user(cls, username):
-        cls.userlist.remove(username)
-        user = cls(username)
-        user.delete()
+        if not cls.users.delete(username):
+            raise UserDoesNotExist('User "{}" does not exist'.format(username))
+
+    def save(self, **fields):
+        self.users.save(self.username, fields)
+        self.fields.update(fields)
 
     @property
     def password(self):
-        return self.redis_dict['password']
+        return self.fields['password']
 
     @password.setter
     def password(self, value):
-        self.redis_dict['password'] = self.hash_password(value)
+        self.save(password=self.hash_password(value))
 
     @staticmethod
     def hash_password(password):
@@ -135,30 +108,35 @@ class User(object):
 
     @property
     def email(self):
-        return self.redis_dict.get('email', '')
+        return self.fields.get('email', '')
 
     @email.setter
     def email(self, value):
-        self.redis_dict['email'] = value
+        self.save(email=value)
 
     def delete(self):
-        self.redis_dict.clear()
+        self.users.delete(self.username)
 
 
 ####
 # Endpoints
 ####
 
+def conflict(exception):
+    return '''<html>
+            <body>
+                <a href="/">home</a>
+                <br />
+                <br />
+                {}
+            </body>
+        </html>'''.format(flask.escape(str(exception))), 409
+
 # Index
 @app.route('/')
 def index():
-    user = RedisSession.get_user()
-    for username in User.userlist:
-        try:
-            try_user = User.get_user(username)
-        except UserDoesNotExist:
-            User.delete_user(username)
-    userlist = '<br />'.join('<a href="/edit-user/{}">{}</a> ({}) <a href="/delete-user/{}">delete</a>'.format(username, username, User.get_user(username).email, username) for username in list(User.userlist))
+    user = Session.get_user()
+    userlist = '<br />'.join('<a href="/edit-user/{}">{}</a> ({}) <a href="/delete-user/{}">delete</a>'.format(each.username, each.username, each.email, each.username) for each in User.all())
     return '''<html>
             <body>
                 Hello, {}!
@@ -190,18 +168,18 @@ def login_post():
     user = User.login(flask.request.form.get('username'), flask.request.form.get('password'))
     if user is None:
         return flask.redirect('/login')
-    RedisSession.set_user(user)
+    Session.set_user(user)
     return flask.redirect('/')
 
 @app.route('/logout')
 def logout():
-    RedisSession.set_user(None)
+    Session.set_user(None)
     return flask.redirect('/login')
 
 # User creation
 @app.route('/create-user')
 def create_user_get():
-    user = RedisSession.get_user()
+    user = Session.get_user()
     return '''<html>
             <body>
                 <a href="/">home</a>
@@ -221,14 +199,16 @@ def create_user_get():
 
 @app.route('/create-user', methods=['POST'])
 def create_user_post():
-    user = RedisSession.get_user()
-    new_user = User.create_user(flask.request.form.get('username'), flask.request.form.get('password'))
-    new_user.email = flask.request.form.get('email', '')
+    user = Session.get_user()
+    try:
+        User.create_user(flask.request.form.get('username'), flask.request.form.get('password'), flask.request.form.get('email', ''))
+    except RedisIndexConflict as exception:
+        return conflict(exception)
     return flask.redirect('/')
 
 @app.route('/edit-user/<edit_username>')
 def edit_user_get(edit_username):
-    user = RedisSession.get_user()
+    user = Session.get_user()
     edit_user = User(edit_username)
     return '''<html>
             <body>
@@ -250,24 +230,29 @@ def edit_user_get(edit_username):
 
 @app.route('/edit-user', methods=['POST'])
 def edit_user_post():
-    user = RedisSession.get_user()
+    user = Session.get_user()
     edit_username = flask.request.form.get('username')
     edit_user = User.get_user(edit_username)
     if edit_user is None:
         # they shouldn't be here if they didn't even pass a valid username
-        RedisSession.set_user(None)
+        Session.set_user(None)
         return flask.redirect('/login')
+    fields = {}
     password = flask.request.form.get('password')
     if password:
-        edit_user.password = password
+        fields['password'] = User.hash_password(password)
     email = flask.request.form.get('email')
     if email:
-        edit_user.email = email
+        fields['email'] = email
+    try:
+        edit_user.save(**fields)
+    except RedisIndexConflict as exception:
+        return conflict(exception)
     return flask.redirect('/')
 
 @app.route('/delete-user/<delete_username>')
 def delete_user(delete_username):
-    user = RedisSession.get_user()
+    user = Session.get_user()
     try:
         User.delete_user(delete_username)
     except UserDoesNotExist: